@@ -1,16 +1,86 @@
 import json
 import os
+import re
+import hashlib
 import time
+import random
 import datetime
 from dateutil import tz
+import dateutil.parser
 import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
+import antiope.aws_account
 from antiope.aws_account import *
 from antiope.foreign_aws_account import *
 
+# Building a boto3 client means loading the service model, resolving the endpoint and a fresh TLS handshake.
+# Clients are cached for the life of the Lambda container, keyed by service, region and credentials.
+CLIENT_MAX_POOL_CONNECTIONS = int(os.getenv('CLIENT_MAX_POOL_CONNECTIONS', default=50))
+CLIENT_CACHE_SIZE = int(os.getenv('CLIENT_CACHE_SIZE', default=128))
+# Throttled calls are retried by botocore's adaptive retry mode, which also slows the client down when it sees throttling
+CLIENT_MAX_ATTEMPTS = int(os.getenv('CLIENT_MAX_ATTEMPTS', default=10))
+client_config = Config(max_pool_connections=CLIENT_MAX_POOL_CONNECTIONS,
+                       retries={'mode': 'adaptive', 'max_attempts': CLIENT_MAX_ATTEMPTS})
+_client_cache = OrderedDict()
+_client_cache_lock = threading.Lock()
+
+# Requests per second (and burst) allowed for services with low, hard API limits. Every client for the same
+# (account, region, service) draws from one TokenBucket, so the worker threads can't gang up on the limit.
+# https://docs.aws.amazon.com/Route53/latest/DeveloperGuide/DNSLimitations.html#limits-api-requests
+API_RATE_LIMITS = {
+    'route53': (5, 5),
+    'route53domains': (5, 5),
+}
+_rate_limiters = {}  # (account_id, region, service) -> TokenBucket
+
+# BatchGetItem hands back the keys DynamoDB didn't get to as UnprocessedKeys when it is throttling. They're retried with
+# exponential backoff and jitter, up to this many attempts per 100 keys.
+BATCH_GET_MAX_ATTEMPTS = int(os.getenv('BATCH_GET_MAX_ATTEMPTS', default=8))
+
+# Error codes botocore retries as throttling. Each one seen is logged and counted in throttle_events
+THROTTLE_ERROR_CODES = ['Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottledException',
+                        'TooManyRequestsException', 'ProvisionedThroughputExceededException', 'RequestLimitExceeded',
+                        'RequestThrottled', 'SlowDown', 'PriorRequestNotComplete', 'EC2ThrottledException',
+                        'TransactionInProgressException', 'BandwidthLimitExceeded', 'LimitExceededException']
+throttle_events = {}  # (service, operation) -> count
+_throttle_lock = threading.Lock()
+
+# Number of regions an inventory handler will work on at the same time
+REGION_MAX_WORKERS = int(os.getenv('REGION_MAX_WORKERS', default=8))
+
+# The Accounts table is scanned in this many parallel segments. The {account_id: account_status} directory built from
+# the scan is kept in the container and in /tmp for ACCOUNT_CACHE_TTL seconds (0 disables the /tmp copy).
+# Bump ACCOUNT_CACHE_VERSION when the cached format changes so old /tmp files are ignored.
+ACCOUNT_SCAN_SEGMENTS = int(os.getenv('ACCOUNT_SCAN_SEGMENTS', default=4))
+ACCOUNT_CACHE_TTL = int(os.getenv('ACCOUNT_CACHE_TTL', default=300))
+ACCOUNT_CACHE_VERSION = 1
+_account_directory_cache = {}  # table_name -> (timestamp, directory)
+_account_directory_lock = threading.Lock()
+
+# AssumeRole credentials are cached in the container and in CREDENTIAL_CACHE_FILE (empty disables the /tmp copy),
+# keyed by role arn and session name. They're used until CREDENTIAL_EXPIRY_MARGIN seconds before they expire, which has
+# to be longer than any function's timeout (900 seconds is the Lambda maximum) so they can't expire partway through a run.
+CREDENTIAL_CACHE_FILE = os.getenv('CREDENTIAL_CACHE_FILE', default="/tmp/sts-credentials.json")
+CREDENTIAL_EXPIRY_MARGIN = max(int(os.getenv('CREDENTIAL_EXPIRY_MARGIN', default=960)), 960)
+
+# Fields that change on every run even when the resource didn't. They're left out of the resource's content hash.
+VOLATILE_RESOURCE_FIELDS = ['configurationItemCaptureTime']
+# S3 user metadata key the content hash is stored under
+RESOURCE_HASH_METADATA = 'antiope-hash'
+# Unchanged resources are written anyway once their object is this many seconds old, in case it was deleted or expired from S3
+RESOURCE_REFRESH_AGE = int(os.getenv('RESOURCE_REFRESH_AGE', default=86400))
+# Manifest entries for resources no run has seen for this many seconds are dropped, the resource is gone
+MANIFEST_ENTRY_MAX_AGE = int(os.getenv('MANIFEST_ENTRY_MAX_AGE', default=7 * 86400))
+# Resources without an awsAccountId are listed in the manifest for this pseudo account, so every resource is in one
+UNATTRIBUTED_ACCOUNT = "unattributed"
+
 
 def parse_tags(tagset):
     """Convert the tagset as returned by AWS into a normal dict of {"tagkey": "tagvalue"}"""
@@ -24,23 +94,617 @@ def parse_tags(tagset):
     return(output)
 
 
+def get_cached_client(service, region=None, creds=None, account_id=None):
+    """
+    Return a boto3 client for service from the module level cache, creating it on first use.
+    creds is an optional dict of AssumeRole credentials (AccessKeyId, SecretAccessKey, SessionToken).
+    account_id selects the rate limiter for services in API_RATE_LIMITS.
+    boto3 clients are thread safe, but creating them from the default session is not, hence the lock.
+    """
+    if creds is None:
+        cache_key = (service, region, None)
+    else:
+        cache_key = (service, region, creds['AccessKeyId'])
+
+    with _client_cache_lock:
+        if cache_key in _client_cache:
+            _client_cache.move_to_end(cache_key)
+            return(_client_cache[cache_key])
+
+        if creds is None:
+            client = boto3.client(service, region_name=region, config=client_config)
+        else:
+            client = boto3.client(service,
+                aws_access_key_id = creds['AccessKeyId'],
+                aws_secret_access_key = creds['SecretAccessKey'],
+                aws_session_token = creds['SessionToken'],
+                region_name = region,
+                config=client_config)
+        install_rate_limiter(client, service, region, account_id)
+        client.meta.events.register('needs-retry', record_throttle)
+        _client_cache[cache_key] = client
+
+        # A warm container works through many accounts, so drop the clients that were used the longest ago
+        if len(_client_cache) > CLIENT_CACHE_SIZE:
+            _client_cache.popitem(last=False)
+        return(client)
+
+
+def install_rate_limiter(client, service, region, account_id):
+    """If service has a known API limit, make every request the client sends (retries included) wait on the shared TokenBucket"""
+    if service not in API_RATE_LIMITS:
+        return()
+    limiter_key = (account_id, region, service)
+    if limiter_key not in _rate_limiters:
+        _rate_limiters[limiter_key] = TokenBucket(*API_RATE_LIMITS[service])
+    bucket = _rate_limiters[limiter_key]
+
+    def wait_for_token(**kwargs):
+        bucket.acquire()  # before-send handlers must return None, or their return value is used as the response
+    client.meta.events.register('before-send', wait_for_token)
+
+
+def record_throttle(response=None, operation=None, attempts=None, **kwargs):
+    """needs-retry handler that logs and counts throttled calls. Returns None so botocore's own retry handler decides"""
+    if response is None:
+        return(None)
+    error_code = response[1].get('Error', {}).get('Code')
+    if error_code in THROTTLE_ERROR_CODES:
+        key = (operation.service_model.service_name, operation.name)
+        with _throttle_lock:
+            throttle_events[key] = throttle_events.get(key, 0) + 1
+        logger.warning(f"{error_code} calling {key[0]}:{key[1]} (attempt {attempts}, {throttle_events[key]} throttles so far)")
+    return(None)
+
+
+def new_resource(service, region=None):
+    """
+    Return a new boto3 resource for service. Resources are not thread safe so each worker needs its own,
+    and building them from the default session has to be serialized the same as clients.
+    """
+    with _client_cache_lock:
+        return(boto3.resource(service, region_name=region))
+
+
+class CredentialCache(object):
+    """
+    AssumeRole credentials keyed by (role_arn, session_name), so a warm container doesn't call STS for every
+    invocation. Entries expiring within expiry_margin seconds are treated as missing.
+    """
+
+    def __init__(self, cache_file=None, expiry_margin=None):
+        self.cache_file = CREDENTIAL_CACHE_FILE if cache_file is None else cache_file
+        self.expiry_margin = CREDENTIAL_EXPIRY_MARGIN if expiry_margin is None else expiry_margin
+        self.entries = None  # (role_arn, session_name) -> creds. Loaded from /tmp on first use
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, role_arn, session_name):
+        """Return the cached credentials, or None if they are missing or about to expire"""
+        with self.lock:
+            if self.entries is None:
+                self.entries = self.load()
+            creds = self.entries.get((role_arn, session_name))
+            if creds is None or not self.is_fresh(creds):
+                self.misses += 1
+                return(None)
+            self.hits += 1
+            return(creds)
+
+    def put(self, role_arn, session_name, creds):
+        """Cache the credentials and save the unexpired ones to /tmp"""
+        with self.lock:
+            if self.entries is None:
+                self.entries = self.load()
+            self.entries[(role_arn, session_name)] = creds
+            self.entries = {k: v for k, v in self.entries.items() if self.is_fresh(v)}
+            self.save()
+
+    def is_fresh(self, creds):
+        expiration = creds['Expiration']
+        if not isinstance(expiration, datetime.datetime):
+            expiration = dateutil.parser.isoparse(expiration)
+        return((expiration - datetime.datetime.now(tz.tzutc())).total_seconds() > self.expiry_margin)
+
+    def load(self):
+        if not self.cache_file:
+            return({})
+        try:
+            with open(self.cache_file) as f:
+                cache = json.load(f)
+        except (IOError, ValueError):
+            return({})
+        return({(e['RoleArn'], e['SessionName']): e['Credentials'] for e in cache})
+
+    def save(self):
+        """Written readable only by us, to a temp file that is renamed so a concurrent reader never sees half a file"""
+        if not self.cache_file:
+            return()
+        cache = [{'RoleArn': k[0], 'SessionName': k[1], 'Credentials': v} for k, v in self.entries.items()]
+        temp_file = f"{self.cache_file}.{os.getpid()}"
+        try:
+            with os.fdopen(os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+                json.dump(cache, f, default=str)
+            os.replace(temp_file, self.cache_file)
+        except (IOError, OSError) as e:
+            logger.warning(f"Unable to cache credentials in {self.cache_file}: {e}")
+
+
+credential_cache = CredentialCache()
+
+
+class AWSAccount(antiope.aws_account.AWSAccount):
+    """
+    The antiope AWSAccount, with get_client() drawing from the client cache so it is safe to call
+    from the for_each_region() worker threads.
+    """
+    def __init__(self, *args, **kwargs):
+        # Only this account's threads wait on its AssumeRole, not every client lookup in the container
+        self.creds_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def get_client(self, type, region=None, session_name=None):
+        """
+        Returns a boto3 client for the service "type" with credentials in the target account.
+        Optionally you can specify the region for the client and the session_name for the AssumeRole.
+        """
+        with self.creds_lock:
+            if 'creds' not in self.__dict__:
+                self.creds = self.get_creds(session_name=session_name)
+        return(get_cached_client(type, region=region, creds=self.creds, account_id=self.account_id))
+
+    def get_creds(self, session_name=None):
+        """
+        Returns the credentials for the cross account role, from the credential cache if they aren't about to expire.
+        Raises AntiopeAssumeRoleError() if the role is not found or cannot be assumed.
+        """
+        if session_name is None:
+            session_name = self.default_session_name
+        creds = credential_cache.get(self.cross_account_role_arn, session_name)
+        if creds is None:
+            creds = super().get_creds(session_name=session_name)
+            credential_cache.put(self.cross_account_role_arn, session_name, creds)
+            logger.debug(f"Assumed {self.cross_account_role_arn}. Credential cache hits: {credential_cache.hits} misses: {credential_cache.misses}")
+        self.creds = creds
+        return(creds)
+
+    @classmethod
+    def from_record(cls, record, config):
+        """Build the AWSAccount from its Accounts table record, rather than querying the table for it like __init__() does"""
+        account = cls.__new__(cls)
+        account.creds_lock = threading.Lock()
+        account.account_id = record['account_id']
+        account.config = config
+        account.account_table = config.account_table
+        account.vpc_table = config.vpc_table
+        account.default_session_name = config.role_session_name
+        if config.role_name is None:
+            account.cross_account_role_arn = None
+        else:
+            account.cross_account_role_arn = "arn:aws:iam::{}:role/{}".format(account.account_id, config.role_name)
+        account.db_record = record
+        account.__dict__.update(record)
+        return(account)
+
+
+def for_each_region(account, fn, regions=None, max_workers=None, skip_errors=('AccessDeniedException',)):
+    """
+    Call fn(region) for each of the account's regions (or the list of regions passed in) from a pool of threads.
+    Regions that fail with a ClientError code in skip_errors (probably SCPs) are logged and skipped.
+    Returns a dict of {region: fn(region)}. Other exceptions are raised once every region has finished,
+    a single failure as-is and several as RegionErrors so capture_error() can report each of them.
+    """
+    if regions is None:
+        regions = account.get_regions()
+    if max_workers is None:
+        max_workers = REGION_MAX_WORKERS
+
+    output = {}
+    errors = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(fn, r): r for r in regions}
+        for future in as_completed(futures):
+            region = futures[future]
+            try:
+                output[region] = future.result()
+            except ClientError as e:
+                if e.response['Error']['Code'] in skip_errors:
+                    logger.error(f"{e.response['Error']['Code']} for region {region} for {account.account_name}({account.account_id})")
+                else:
+                    errors.append((region, e))
+            except Exception as e:
+                errors.append((region, e))
+
+    for region, e in errors:
+        if isinstance(e, AntiopeAssumeRoleError):
+            raise e  # Not a regional problem, let the handler deal with it the usual way
+    if len(errors) == 1:
+        raise errors[0][1]
+    if len(errors) > 1:
+        raise RegionErrors(errors)
+    return(output)
+
+
+def utc_now():
+    return(datetime.datetime.now(datetime.timezone.utc))
+
+
+def is_older_than(isodate, seconds):
+    """True if the ISO 8601 timestamp isodate is more than seconds ago"""
+    return((utc_now() - dateutil.parser.isoparse(isodate)).total_seconds() > seconds)
+
+
 def save_resource_to_s3(prefix, resource_id, resource):
-    """Saves the resource to S3 in prefix with the object name of resource_id.json"""
-    if "/" in resource_id:
-        logger.error(f"{resource_id} contains a / character and cannot be safely stored in S3 under {prefix}")
-        resource_id.replace("/", "-")
+    """
+    Queues the resource to be saved to S3 in prefix with the object name of resource_id.json.
+    The PUT happens on the resource_writer thread pool, so handlers must call flush_resources() before they exit.
+    Resources whose content hash matches the object already in S3 are not rewritten.
+    """
+    resource_writer.save(prefix, resource_id, resource)
+
+
+def resource_hash(resource):
+    """Return a hash of the resource's canonical json, ignoring the VOLATILE_RESOURCE_FIELDS"""
+    stable = {k: v for k, v in resource.items() if k not in VOLATILE_RESOURCE_FIELDS}
+    return(hashlib.sha256(json.dumps(stable, sort_keys=True, default=str).encode('utf-8')).hexdigest())
+
+
+class ResourceWriter(object):
+    """Writes inventory resources to the INVENTORY_BUCKET from a bounded pool of threads"""
+    def __init__(self, max_workers=None, max_pending=None, skip_unchanged=None):
+        super(ResourceWriter, self).__init__()
+        if max_workers is None:
+            max_workers = int(os.getenv('RESOURCE_WRITER_WORKERS', default=16))
+        if max_pending is None:
+            max_pending = max_workers * 4
+        if skip_unchanged is None:
+            skip_unchanged = os.getenv('SKIP_UNCHANGED_RESOURCES', default="True") == "True"
+        self.skip_unchanged = skip_unchanged
+
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        # Block the collector once max_pending writes are in flight so a huge account can't queue up everything in memory
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.pending = {}  # future -> object_key
+        self.lock = threading.Lock()
+        self.manifests = {}  # (prefix, account_id) -> ResourceManifest
+        self.count = 0
+        self.skipped = 0
+
+    def manifest(self, prefix, account_id):
+        """Return the ResourceManifest for this account's objects under prefix, loading it the first time it's asked for"""
+        with self.lock:
+            if (prefix, account_id) not in self.manifests:
+                self.manifests[(prefix, account_id)] = ResourceManifest(prefix, account_id)
+            return(self.manifests[(prefix, account_id)])
+
+    def save(self, prefix, resource_id, resource):
+        """Serialize the resource and queue the PUT. Serializing happens now since callers reuse their resource_item dicts"""
+        if "/" in resource_id:
+            logger.error(f"{resource_id} contains a / character and cannot be safely stored in S3 under {prefix}")
+            resource_id = resource_id.replace("/", "-")
 
-    s3client = boto3.client('s3')
-    try:
         object_key = "Resources/{}/{}.json".format(prefix, resource_id)
+        body = json.dumps(resource, sort_keys=True, default=str, indent=2)
+        content_hash = resource_hash(resource)
+        manifest = self.manifest(prefix, resource.get('awsAccountId', UNATTRIBUTED_ACCOUNT))
+
+        self.slots.acquire()
+        future = self.executor.submit(self._put_object, object_key, resource_id, body, content_hash, manifest)
+        with self.lock:
+            self.pending[future] = object_key
+        future.add_done_callback(lambda f: self.slots.release())
+        return(future)
+
+    def _put_object(self, object_key, resource_id, body, content_hash, manifest):
+        """PUT the object unless S3 already has this content. Returns True if the object was written"""
+        s3client = get_cached_client('s3')
+        if self.skip_unchanged:
+            if manifest.exists:
+                stored = manifest.get(resource_id)
+            else:
+                # No manifest yet for this account & prefix, so ask S3 directly
+                stored = self._head_object(s3client, object_key)
+            if stored is not None and stored['hash'] == content_hash and not is_older_than(stored['LastModified'], RESOURCE_REFRESH_AGE):
+                manifest.update(resource_id, content_hash, stored['LastModified'])
+                return(False)
+
         s3client.put_object(
-            Body=json.dumps(resource, sort_keys=True, default=str, indent=2),
+            Body=body,
             Bucket=os.environ['INVENTORY_BUCKET'],
             ContentType='application/json',
             Key=object_key,
+            Metadata={RESOURCE_HASH_METADATA: content_hash},
         )
-    except ClientError as e:
-        logger.error("Unable to save object {}: {}".format(object_key, e))
+        manifest.update(resource_id, content_hash, utc_now().isoformat())
+        return(True)
+
+    def _head_object(self, s3client, object_key):
+        """Return the manifest entry for the object currently in S3, or None if it is missing or predates hashing"""
+        try:
+            response = s3client.head_object(Bucket=os.environ['INVENTORY_BUCKET'], Key=object_key)
+        except ClientError as e:  # Object is missing, or other error. Either way write it.
+            return(None)
+        if RESOURCE_HASH_METADATA not in response.get('Metadata', {}):
+            return(None)
+        return({'LastModified': response['LastModified'].isoformat(), 'hash': response['Metadata'][RESOURCE_HASH_METADATA]})
+
+    def flush(self):
+        """Wait for all the queued writes to finish. Returns a dict of {object_key: error} for the writes that failed"""
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+            manifests = self.manifests
+            self.manifests = {}
+
+        errors = {}
+        skipped = 0
+        for future in as_completed(pending):
+            object_key = pending[future]
+            try:
+                if not future.result():
+                    skipped += 1
+            except Exception as e:
+                logger.error("Unable to save object {}: {}".format(object_key, e))
+                errors[object_key] = e
+
+        # Reload the manifests on the next invocation, another container may have rewritten them since
+        for manifest in manifests.values():
+            try:
+                manifest.save()
+            except ClientError as e:
+                logger.error("Unable to save manifest {}: {}".format(manifest.object_key, e))
+                errors[manifest.object_key] = e
+
+        self.count += len(pending) - len(errors) - skipped
+        self.skipped += skipped
+        if pending:
+            logger.info(f"Flushed {len(pending)} objects to S3: {len(pending) - len(errors) - skipped} written, {skipped} unchanged and skipped, {len(errors)} errors")
+        return(errors)
+
+
+class ResourceManifest(object):
+    """
+    Index of the objects one account has under Resources/prefix, stored in the INVENTORY_BUCKET as a single
+    json object at Manifests/prefix/account_id.json mapping {resource_id: {"LastModified": isodate, "LastSeen": isodate, "hash": content_hash}}.
+    LastModified is when the object was written, LastSeen when a run last saved the resource, written or not.
+    It is read once per run so existence, freshness and change checks are dict lookups instead of a HEAD per object.
+    """
+    def __init__(self, prefix, account_id):
+        super(ResourceManifest, self).__init__()
+        self.prefix = prefix
+        self.account_id = account_id
+        self.object_key = f"Manifests/{prefix}/{account_id}.json"
+        self.entries = {}
+        self.exists = False  # False until a run has saved the manifest. Callers should fall back to asking S3.
+        self.dirty = False
+        self.lock = threading.Lock()
+
+        s3client = get_cached_client('s3')
+        try:
+            response = s3client.get_object(Bucket=os.environ['INVENTORY_BUCKET'], Key=self.object_key)
+            self.entries = json.loads(response['Body'].read())
+            self.exists = True
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchKey':
+                logger.error("Unable to load manifest {}: {}".format(self.object_key, e))
+
+    def get(self, resource_id):
+        """Return the {"LastModified", "LastSeen", "hash"} entry for resource_id, or None if it's not in S3"""
+        with self.lock:
+            return(self.entries.get(resource_id))
+
+    def last_modified(self, resource_id):
+        """Return when resource_id was last written to S3 as a datetime, or None if it's not in S3"""
+        entry = self.get(resource_id)
+        if entry is None:
+            return(None)
+        return(dateutil.parser.isoparse(entry['LastModified']))
+
+    def last_seen(self, resource_id):
+        """Return when a run last saved resource_id as a datetime, even if the write was skipped, or None if it's not in S3"""
+        entry = self.get(resource_id)
+        if entry is None:
+            return(None)
+        return(dateutil.parser.isoparse(entry.get('LastSeen', entry['LastModified'])))
+
+    def update(self, resource_id, content_hash, last_modified):
+        with self.lock:
+            self.entries[resource_id] = {'LastModified': last_modified, 'LastSeen': utc_now().isoformat(), 'hash': content_hash}
+            self.dirty = True
+
+    def save(self):
+        """
+        Rewrite the manifest if anything changed, dropping the entries not seen for MANIFEST_ENTRY_MAX_AGE.
+        It's a single PUT, so readers see either the old or the new manifest.
+        """
+        with self.lock:
+            if not self.dirty:
+                return()
+            self.entries = {k: v for k, v in self.entries.items() if not is_older_than(v.get('LastSeen', v['LastModified']), MANIFEST_ENTRY_MAX_AGE)}
+            body = json.dumps(self.entries, sort_keys=True)
+            self.dirty = False
+        s3client = get_cached_client('s3')
+        s3client.put_object(
+            Body=body,
+            Bucket=os.environ['INVENTORY_BUCKET'],
+            ContentType='application/json',
+            Key=self.object_key,
+        )
+
+
+# Shared by every handler in the container. Handlers flush it before returning, with flush_resources().
+resource_writer = ResourceWriter()
+
+
+def flush_resources(event, context):
+    """
+    Flush the resource_writer, and report any objects that couldn't be saved to the error queue so a partially written
+    inventory doesn't look like a success. Returns the {object_key: error} dict from flush().
+    """
+    errors = resource_writer.flush()
+    if errors:
+        failed = sorted(errors)
+        message = f"Unable to save {len(failed)} objects to S3: {', '.join(failed[:10])}{' ...' if len(failed) > 10 else ''}"
+        logger.error(message)
+        capture_error(event, context, errors[failed[0]], message)
+    return(errors)
+
+
+class S3MultipartWriter(object):
+    """
+    File-like object that streams what is written to it into an S3 object with a multipart upload, so large reports
+    don't have to be built in memory or in /tmp first. Anything that fits in one part is sent with a single put_object().
+    Use it as a context manager, or call close() (or abort() if something went wrong) when done.
+    """
+
+    def __init__(self, object_key, content_type, bucket=None, part_size=8 * 1024 * 1024, **kwargs):
+        self.s3_client = get_cached_client('s3')
+        self.bucket = os.environ['INVENTORY_BUCKET'] if bucket is None else bucket
+        self.object_key = object_key
+        self.put_args = dict(kwargs, ContentType=content_type)  # Any other put_object() args, like ContentEncoding
+        self.part_size = max(part_size, 5 * 1024 * 1024)  # S3's minimum for every part but the last
+        self.buffer = []
+        self.buffer_size = 0
+        self.upload_id = None
+        self.parts = []
+        self.size = 0
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.buffer.append(data)
+        self.buffer_size += len(data)
+        self.size += len(data)
+        if self.buffer_size >= self.part_size:
+            self.upload_part()
+        return(len(data))
+
+    def upload_part(self):
+        if self.upload_id is None:
+            response = self.s3_client.create_multipart_upload(Bucket=self.bucket, Key=self.object_key, **self.put_args)
+            self.upload_id = response['UploadId']
+        part_number = len(self.parts) + 1
+        response = self.s3_client.upload_part(Bucket=self.bucket, Key=self.object_key, UploadId=self.upload_id,
+                                              PartNumber=part_number, Body=b"".join(self.buffer))
+        self.parts.append({'PartNumber': part_number, 'ETag': response['ETag']})
+        self.buffer = []
+        self.buffer_size = 0
+
+    def flush(self):
+        pass  # Parts can only be uploaded once they're big enough, see write()
+
+    def write_object(self, object_key, size):
+        """
+        Append the size bytes of another object in the bucket. If it can be a part on its own it is copied server side,
+        otherwise it is streamed through write().
+        """
+        if self.buffer_size == 0 and 5 * 1024 * 1024 <= size <= 5 * 1024 * 1024 * 1024:
+            if self.upload_id is None:
+                response = self.s3_client.create_multipart_upload(Bucket=self.bucket, Key=self.object_key, **self.put_args)
+                self.upload_id = response['UploadId']
+            part_number = len(self.parts) + 1
+            response = self.s3_client.upload_part_copy(Bucket=self.bucket, Key=self.object_key, UploadId=self.upload_id,
+                                                       PartNumber=part_number, CopySource={'Bucket': self.bucket, 'Key': object_key})
+            self.parts.append({'PartNumber': part_number, 'ETag': response['CopyPartResult']['ETag']})
+            self.size += size
+            return()
+        body = self.s3_client.get_object(Bucket=self.bucket, Key=object_key)['Body']
+        for chunk in iter(lambda: body.read(self.part_size), b""):
+            self.write(chunk)
+
+    def close(self):
+        if self.upload_id is None:
+            self.s3_client.put_object(Bucket=self.bucket, Key=self.object_key, Body=b"".join(self.buffer), **self.put_args)
+        else:
+            if self.buffer:
+                self.upload_part()
+            self.s3_client.complete_multipart_upload(Bucket=self.bucket, Key=self.object_key, UploadId=self.upload_id,
+                                                     MultipartUpload={'Parts': self.parts})
+        logger.debug(f"Wrote {self.size} bytes to s3://{self.bucket}/{self.object_key} in {max(len(self.parts), 1)} parts")
+
+    def abort(self):
+        if self.upload_id is None:
+            return()
+        try:
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.object_key, UploadId=self.upload_id)
+        except ClientError as e:
+            logger.error(f"Unable to abort the upload of {self.object_key}: {e}")
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+# Account ids this container has already seen in the ACCOUNT_TABLE. Accounts aren't removed from the table, so this never goes stale.
+_known_account_ids = set()
+
+
+class ForeignAccountRegistrar(object):
+    """
+    Adds the accounts that the inventoried account trusts (or gets AMIs from) to the ACCOUNT_TABLE as FOREIGN accounts.
+    Call add() for every principal found, then register() once to look them all up and write the unknown ones.
+    """
+    def __init__(self, attributes=None, table_name=None):
+        super(ForeignAccountRegistrar, self).__init__()
+        self.attributes = attributes or {}  # Extra attributes to set on the new FOREIGN accounts
+        self.table_name = table_name or os.environ['ACCOUNT_TABLE']
+        self.account_ids = set()
+        self.lock = threading.Lock()
+
+    def add(self, principal, source_arn=None):
+        """Note the account for an AWS Principal, which can be an ARN or just an account ID"""
+        if principal.startswith("arn"):
+            account_id = principal.split(':')[4]
+        elif re.match('^[0-9]{12}$', principal):
+            account_id = principal
+        elif principal == "*":
+            logger.error("Found an assume role policy that trusts everything!!!: {}".format(source_arn))
+            return()  # No accounts to add to the DB
+        else:
+            logger.error("Unable to identify what kind of AWS Principal this is: {}".format(principal))
+            return()
+
+        with self.lock:
+            self.account_ids.add(account_id)
+
+    def register(self):
+        """Add the accounts that aren't in the ACCOUNT_TABLE. Returns the list of account_ids that were added"""
+        with self.lock:
+            account_ids = sorted(self.account_ids - _known_account_ids)
+            self.account_ids = set()
+
+        dynamodb = new_resource('dynamodb')
+        unknown = set(account_ids)
+        keys = [{'account_id': a} for a in account_ids]
+        for item in batch_get_items(dynamodb, self.table_name, keys, ProjectionExpression='account_id', ConsistentRead=True):
+            unknown.discard(item['account_id'])
+            _known_account_ids.add(item['account_id'])
+
+        # BatchWriteItem can't do conditional writes, and there are only ever a few new accounts, so put them one at a time.
+        # The condition stops us from clobbering an account another Lambda (or the org sync) added since we looked.
+        account_table = dynamodb.Table(self.table_name)
+        added = []
+        for account_id in sorted(unknown):
+            item = {
+                'account_id':       account_id,
+                'account_name':     "unknown",
+                'account_status':   "FOREIGN",
+            }
+            item.update(self.attributes)
+            try:
+                account_table.put_item(Item=item, ConditionExpression='attribute_not_exists(account_id)')
+                logger.info(u"Adding foreign account {}".format(account_id))
+                added.append(account_id)
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise AccountUpdateError(u"Unable to create {}: {}".format(account_id, e))
+            _known_account_ids.add(account_id)
+        return(added)
 
 
 def get_active_accounts(table_name=None):
@@ -50,57 +714,208 @@ def get_active_accounts(table_name=None):
     antiope_config = AntiopeConfig()
 
     account_ids = get_account_ids(status="ACTIVE", table_name=table_name)
+    return(get_accounts(account_ids, table_name=table_name, config=antiope_config))
+
+
+def get_accounts(account_ids, table_name=None, config=None):
+    """
+    Returns an array of AWSAccount objects for account_ids, in the same order. Ids not in the Accounts table are left out.
+    The records are fetched with BatchGetItem, 100 at a time, instead of one query per AWSAccount().
+    """
+    if table_name is None:
+        table_name = os.environ['ACCOUNT_TABLE']
+    if config is None:
+        config = AntiopeConfig()
+
+    account_ids = list(account_ids)
+    dynamodb = new_resource('dynamodb')
+    records = {}
+    # BatchGetItem rejects a request with the same key twice
+    for item in batch_get_items(dynamodb, table_name, [{'account_id': a} for a in sorted(set(account_ids))]):
+        records[item['account_id']] = item
+
     output = []
     for a in account_ids:
-        output.append(AWSAccount(a, config=antiope_config))
+        if a in records:
+            output.append(AWSAccount.from_record(records[a], config))
+        else:
+            logger.debug(f"Account {a} not found in {table_name}")
     return(output)
 
 
+def batch_get_items(dynamodb, table_name, keys, **request_args):
+    """
+    Returns the items in table_name for keys, fetched with BatchGetItem 100 keys at a time. request_args are added to
+    each request, eg ProjectionExpression. Raises AntiopeDatabaseError if DynamoDB keeps leaving keys unprocessed.
+    """
+    items = []
+    for i in range(0, len(keys), 100):  # BatchGetItem takes 100 keys at a time
+        request = {table_name: dict(request_args, Keys=keys[i:i + 100])}
+        for attempt in range(BATCH_GET_MAX_ATTEMPTS):
+            response = dynamodb.batch_get_item(RequestItems=request)
+            items += response['Responses'].get(table_name, [])
+            request = response.get('UnprocessedKeys')
+            if not request:
+                break
+            if attempt == BATCH_GET_MAX_ATTEMPTS - 1:
+                raise AntiopeDatabaseError(f"{len(request[table_name]['Keys'])} keys still unprocessed in {table_name} after {BATCH_GET_MAX_ATTEMPTS} attempts")
+            delay = random.uniform(0, 0.1 * 2 ** attempt)  # Full jitter, so the retrying Lambdas don't all come back at once
+            logger.warning(f"{len(request[table_name]['Keys'])} keys unprocessed in {table_name}, retrying in {delay:.2f} sec")
+            time.sleep(delay)
+    return(items)
+
+
 def get_foreign_accounts():
     """Returns an array of all active AWS accounts as AWSAccount objects"""
-    foreign_account_ids = get_account_ids(status="FOREIGN")
-    trusted_account_ids = get_account_ids(status="TRUSTED")
+    directory = get_account_directory()
     output = []
-    for a in trusted_account_ids:
-        output.append(ForeignAWSAccount(a))
-    for a in foreign_account_ids:
-        output.append(ForeignAWSAccount(a))
+    for a in directory:
+        if directory[a] == "TRUSTED":
+            output.append(ForeignAWSAccount(a))
+    for a in directory:
+        if directory[a] == "FOREIGN":
+            output.append(ForeignAWSAccount(a))
     return(output)
 
 
 def get_account_ids(status=None, table_name=None):
     """return an array of account_ids from the Accounts table. Optionally, filter by status"""
-    dynamodb = boto3.resource('dynamodb')
-    if table_name:
-        account_table = dynamodb.Table(table_name)
-    else:
-        account_table = dynamodb.Table(os.environ['ACCOUNT_TABLE'])
-
-    account_list = []
-    response = account_table.scan(
-        AttributesToGet=['account_id', 'account_status']
-    )
-    while 'LastEvaluatedKey' in response:
-        # Means that dynamoDB didn't return the full set, so ask for more.
-        account_list = account_list + response['Items']
-        response = account_table.scan(
-            AttributesToGet=['account_id', 'account_status'],
-            ExclusiveStartKey=response['LastEvaluatedKey']
-        )
-    account_list = account_list + response['Items']
+    directory = get_account_directory(table_name)
     output = []
-    for a in account_list:
+    for account_id, account_status in directory.items():
         if status is None:  # Then we get everything
-            output.append(a['account_id'])
-        elif a['account_status'] == status:  # this is what we asked for
-            output.append(a['account_id'])
+            output.append(account_id)
+        elif account_status == status:  # this is what we asked for
+            output.append(account_id)
         # Otherwise, don't bother.
     return(output)
 
 
+def get_account_directory(table_name=None):
+    """
+    Return a dict of {account_id: account_status} for every account in the Accounts table.
+    One scan serves every status, and the result is cached in the container and in /tmp for ACCOUNT_CACHE_TTL seconds.
+    """
+    if table_name is None:
+        table_name = os.environ['ACCOUNT_TABLE']
+
+    with _account_directory_lock:
+        if table_name in _account_directory_cache:
+            timestamp, directory = _account_directory_cache[table_name]
+            if time.time() - timestamp < ACCOUNT_CACHE_TTL:
+                return(directory)
+
+        cache_file = f"/tmp/account-directory-{table_name}.json"
+        timestamp, directory = read_account_directory_cache(cache_file, table_name)
+        if directory is None:
+            timestamp = time.time()
+            directory = {}
+            for item in scan_table(table_name, ['account_id', 'account_status']):
+                directory[item['account_id']] = item.get('account_status')
+            write_account_directory_cache(cache_file, table_name, timestamp, directory)
+
+        _account_directory_cache[table_name] = (timestamp, directory)
+        return(directory)
+
+
+def read_account_directory_cache(cache_file, table_name):
+    """Return (timestamp, directory) from the /tmp cache, or (None, None) if it's missing, expired or from another version"""
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        return(None, None)
+    if cache.get('version') != ACCOUNT_CACHE_VERSION or cache.get('table_name') != table_name:
+        return(None, None)
+    if time.time() - cache['timestamp'] >= ACCOUNT_CACHE_TTL:
+        return(None, None)
+    return(cache['timestamp'], cache['accounts'])
+
+
+def write_account_directory_cache(cache_file, table_name, timestamp, directory):
+    """Save the directory to /tmp. Written to a temp file and renamed so a concurrent reader never sees half a file"""
+    if ACCOUNT_CACHE_TTL <= 0:
+        return()
+    cache = {'version': ACCOUNT_CACHE_VERSION, 'table_name': table_name, 'timestamp': timestamp, 'accounts': directory}
+    try:
+        with open(f"{cache_file}.{os.getpid()}", "w") as f:
+            json.dump(cache, f)
+        os.replace(f"{cache_file}.{os.getpid()}", cache_file)
+    except (IOError, OSError) as e:
+        logger.warning(f"Unable to cache the account directory in {cache_file}: {e}")
+
+
+def scan_table(table_name, attributes=None, segments=None, filter_expression=None):
+    """
+    Return every item in the DynamoDB table, scanned as segments parallel scans.
+    If attributes is given, only those attributes are returned for each item.
+    filter_expression (a boto3.dynamodb.conditions condition) is applied by DynamoDB, so only matching items are returned.
+    """
+    if segments is None:
+        segments = ACCOUNT_SCAN_SEGMENTS
+
+    scan_args = {'TotalSegments': segments}
+    if attributes:
+        scan_args['ProjectionExpression'] = ", ".join([f"#a{i}" for i in range(len(attributes))])
+        scan_args['ExpressionAttributeNames'] = {f"#a{i}": a for i, a in enumerate(attributes)}
+    if filter_expression is not None:
+        scan_args['FilterExpression'] = filter_expression
+
+    def scan_segment(segment):
+        table = new_resource('dynamodb').Table(table_name)
+        items = []
+        response = table.scan(Segment=segment, **scan_args)
+        while 'LastEvaluatedKey' in response:
+            # Means that dynamoDB didn't return the full set, so ask for more.
+            items += response['Items']
+            response = table.scan(Segment=segment, ExclusiveStartKey=response['LastEvaluatedKey'], **scan_args)
+        items += response['Items']
+        return(items)
+
+    output = []
+    with ThreadPoolExecutor(max_workers=segments) as executor:
+        for items in executor.map(scan_segment, range(segments)):
+            output += items
+    return(output)
+
+
+class TokenBucket(object):
+    """Allows rate operations per second on average, in bursts of up to burst. acquire() blocks until there is capacity"""
+    def __init__(self, rate, burst=None):
+        super(TokenBucket, self).__init__()
+        self.rate = float(rate)
+        self.burst = float(burst) if burst is not None else max(self.rate, 1.0)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """Take tokens from the bucket, sleeping until they are available. Returns the number of seconds spent waiting"""
+        tokens = min(tokens, self.burst)  # Otherwise we'd wait forever
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return(waited)
+                delay = (tokens - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
 def capture_error(event, context, error, message):
     '''When an exception is thrown, this function will publish a SQS message for later retrival'''
-    sqs_client = boto3.client('sqs')
+    if isinstance(error, RegionErrors):
+        # Publish one message per region that failed
+        output = []
+        for region, region_error in error.errors:
+            output.append(capture_error(event, context, region_error, f"{message} ({region}: {region_error})"))
+        return(output)
+
+    sqs_client = get_cached_client('sqs')
 
     queue_url = os.environ['ERROR_QUEUE']
 
@@ -131,3 +946,10 @@ def set_debug(event, logger):
 
 class LambdaRunningOutOfTime(Exception):
     '''raised by functions when the timeout is about to be hit'''
+
+
+class RegionErrors(Exception):
+    '''raised by for_each_region() when more than one region failed. errors is a list of (region, exception)'''
+    def __init__(self, errors):
+        self.errors = errors
+        super(RegionErrors, self).__init__("{} regions failed: {}".format(len(errors), ", ".join([r for r, e in errors])))
@@ -0,0 +1,250 @@
+import boto3
+from botocore.exceptions import ClientError
+import json
+import os
+import time
+import datetime
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from antiope.aws_account import *
+from common import *
+
+import logging
+logger = logging.getLogger()
+logger.setLevel(getattr(logging, os.getenv('LOG_LEVEL', default='INFO')))
+logging.getLogger('botocore').setLevel(logging.WARNING)
+logging.getLogger('boto3').setLevel(logging.WARNING)
+logging.getLogger('urllib3').setLevel(logging.WARNING)
+
+# Each run's Resources/prefix objects are compacted into Snapshots/prefix/timestamp.ndjson.gz, one resource per line.
+# Every account's resources are a separate gzip member, so with the offsets in Snapshots/prefix/timestamp.index.json
+# one account can be read with a ranged GET. Resources without an awsAccountId are under UNATTRIBUTED_ACCOUNT.
+SNAPSHOT_PATH = "Snapshots"
+# Number of resource objects downloaded at the same time
+COMPACTION_FETCH_WORKERS = int(os.getenv('COMPACTION_FETCH_WORKERS', default=32))
+# Each prefix is split into shards of about this many bytes of manifest (roughly 200 bytes per resource), each compacted
+# by its own invocation of handler() into Snapshots/prefix/timestamp.shards/. An account with a bigger manifest is
+# split into pages. finish_handler() then puts the shards together into the prefix's snapshot.
+COMPACTION_SHARD_MANIFEST_BYTES = int(os.getenv('COMPACTION_SHARD_MANIFEST_BYTES', default=4 * 1024 * 1024))
+
+
+# Lambda main routine
+def list_handler(event, context):
+    '''Add the shards and prefixes to compact to the event, for the state machine to run handler() and finish_handler() on'''
+    set_debug(event, logger)
+    logger.debug("Received event: " + json.dumps(event, sort_keys=True))
+
+    manifests = get_manifest_accounts()
+    event['compaction_shards'] = []
+    for prefix in sorted(manifests):
+        event['compaction_shards'] += plan_shards(prefix, manifests[prefix])
+    event['compaction_prefixes'] = sorted(manifests)
+    logger.info(f"Split {len(event['compaction_prefixes'])} prefixes into {len(event['compaction_shards'])} shards to compact")
+    return(event)
+
+
+def handler(event, context):
+    '''Compact one shard of a Resources/{prefix} into Snapshots/{prefix}/{timestamp}.shards/'''
+    set_debug(event, logger)
+    logger.info("Received event: " + json.dumps(event, sort_keys=True))
+
+    shard = event['shard']
+    prefix = shard['prefix']
+    shard_key = f"{SNAPSHOT_PATH}/{prefix}/{event['timestamp']}.shards/{shard['shard']:05d}"
+    index = {
+        'resourceTypes': [],
+        'rows': 0,
+        'accounts': {}  # awsAccountId -> {offset, length, rows}
+    }
+    start_time = time.time()
+    duplicates = 0
+
+    with S3MultipartWriter(f"{shard_key}.ndjson.gz", 'application/gzip') as writer:
+        member = None
+        for account_id, resource in fetch_resources(prefix, shard_resource_ids(shard)):
+            if resource is None:
+                continue
+            # A resource in more than one account's manifest only goes in the snapshot under the account it says it's in
+            if resource.get('awsAccountId', UNATTRIBUTED_ACCOUNT) != account_id:
+                duplicates += 1
+                continue
+            if member is None or member['account_id'] != account_id:
+                finish_member(writer, member, index)
+                # wbits=31 makes a gzip member, rather than a raw zlib stream
+                member = {'account_id': account_id, 'offset': writer.size, 'rows': 0, 'compressor': zlib.compressobj(wbits=31)}
+            writer.write(member['compressor'].compress((json.dumps(resource, sort_keys=True, default=str) + "\n").encode('utf-8')))
+            member['rows'] += 1
+            if 'resourceType' in resource and resource['resourceType'] not in index['resourceTypes']:
+                index['resourceTypes'].append(resource['resourceType'])
+        finish_member(writer, member, index)
+
+    index['size'] = writer.size
+    save_index(f"{shard_key}.index.json", index)
+    logger.info(f"Compacted {index['rows']} {prefix} resources from {len(index['accounts'])} accounts into {writer.size} bytes "
+                f"in {time.time() - start_time:.1f} sec. Skipped {duplicates} that belong to another account")
+    return({'prefix': prefix, 'shard': shard['shard'], 'rows': index['rows'], 'bytes': writer.size})
+
+
+def finish_handler(event, context):
+    '''Put the shards of Resources/{prefix} together into Snapshots/{prefix}/{timestamp}.ndjson.gz and its index'''
+    set_debug(event, logger)
+    logger.info("Received event: " + json.dumps(event, sort_keys=True))
+
+    prefix = event['prefix']
+    shard_path = f"{SNAPSHOT_PATH}/{prefix}/{event['timestamp']}.shards/"
+    object_key = f"{SNAPSHOT_PATH}/{prefix}/{event['timestamp']}.ndjson.gz"
+    index = {
+        'prefix': prefix,
+        'timestamp': event['timestamp'],
+        'object_key': object_key,
+        'resourceTypes': [],
+        'rows': 0,
+        'unattributed_rows': 0,
+        'accounts': {}  # awsAccountId (or UNATTRIBUTED_ACCOUNT) -> {offset, length, first_row, rows}
+    }
+
+    s3_client = get_cached_client('s3')
+    shard_keys = []
+    for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=os.environ['INVENTORY_BUCKET'], Prefix=shard_path):
+        shard_keys += [o['Key'] for o in page.get('Contents', [])]
+
+    with S3MultipartWriter(object_key, 'application/gzip') as writer:
+        for index_key in sorted(k for k in shard_keys if k.endswith(".index.json")):
+            response = s3_client.get_object(Bucket=os.environ['INVENTORY_BUCKET'], Key=index_key)
+            shard_index = json.loads(response['Body'].read())
+            base = writer.size
+            if shard_index['size'] > 0:
+                writer.write_object(index_key[:-len(".index.json")] + ".ndjson.gz", shard_index['size'])
+            # Shards are in account order, and the gzip members of an account split into pages are next to each other
+            for account_id, member in sorted(shard_index['accounts'].items(), key=lambda a: a[1]['offset']):
+                if account_id in index['accounts']:
+                    index['accounts'][account_id]['length'] += member['length']
+                    index['accounts'][account_id]['rows'] += member['rows']
+                else:
+                    index['accounts'][account_id] = {'offset': base + member['offset'], 'length': member['length'],
+                                                     'first_row': index['rows'], 'rows': member['rows']}
+                index['rows'] += member['rows']
+            for resource_type in shard_index['resourceTypes']:
+                if resource_type not in index['resourceTypes']:
+                    index['resourceTypes'].append(resource_type)
+
+    index['unattributed_rows'] = index['accounts'].get(UNATTRIBUTED_ACCOUNT, {}).get('rows', 0)
+    save_index(f"{SNAPSHOT_PATH}/{prefix}/{event['timestamp']}.index.json", index)
+    for i in range(0, len(shard_keys), 1000):  # DeleteObjects takes 1000 keys at a time
+        s3_client.delete_objects(Bucket=os.environ['INVENTORY_BUCKET'],
+                                 Delete={'Objects': [{'Key': k} for k in shard_keys[i:i + 1000]], 'Quiet': True})
+    logger.info(f"Snapshot of {prefix} has {index['rows']} resources from {len(index['accounts'])} accounts in {writer.size} bytes")
+    return({'prefix': prefix, 'rows': index['rows'], 'bytes': writer.size})
+
+
+def get_manifest_accounts(prefix=None):
+    '''Returns {prefix: [(account_id, manifest_size), ...]} from the Manifests/ objects, optionally just for one prefix'''
+    s3_client = get_cached_client('s3')
+    list_prefix = "Manifests/" if prefix is None else f"Manifests/{prefix}/"
+    output = {}
+    for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=os.environ['INVENTORY_BUCKET'], Prefix=list_prefix):
+        for o in page.get('Contents', []):
+            # Manifests/{prefix}/{account_id}.json, where the prefix has a / in it
+            manifest_prefix, file_name = o['Key'][len("Manifests/"):].rsplit("/", 1)
+            output.setdefault(manifest_prefix, []).append((file_name[:-len(".json")], o['Size']))
+    return(output)
+
+
+def plan_shards(prefix, accounts):
+    '''
+    Split the accounts with a manifest for prefix into shards of about COMPACTION_SHARD_MANIFEST_BYTES.
+    A shard is a range of account ids, so the state machine's state stays small however many accounts there are.
+    '''
+    shards = []
+    group = []
+    group_size = 0
+    for account_id, size in sorted(accounts):
+        # This also ends the group before an account too big for one shard, so the ranges don't overlap
+        if group and group_size + size > COMPACTION_SHARD_MANIFEST_BYTES:
+            shards.append({'prefix': prefix, 'accounts': [group[0], group[-1]]})
+            group = []
+            group_size = 0
+        if size > COMPACTION_SHARD_MANIFEST_BYTES:
+            pages = -(-size // COMPACTION_SHARD_MANIFEST_BYTES)
+            for page in range(pages):
+                shards.append({'prefix': prefix, 'accounts': [account_id, account_id], 'page': page, 'pages': pages})
+            continue
+        group.append(account_id)
+        group_size += size
+    if group:
+        shards.append({'prefix': prefix, 'accounts': [group[0], group[-1]]})
+    for n, shard in enumerate(shards):
+        shard['shard'] = n
+    return(shards)
+
+
+def shard_resource_ids(shard):
+    '''Yields (account_id, resource_id) for the resources in the shard, in account order'''
+    first, last = shard['accounts']
+    account_ids = [a for a, size in get_manifest_accounts(shard['prefix']).get(shard['prefix'], []) if first <= a <= last]
+    manifests = load_manifests(shard['prefix'], sorted(account_ids))
+    for account_id in sorted(account_ids):
+        resource_ids = sorted(manifests[account_id].entries)
+        if 'pages' in shard:
+            resource_ids = resource_ids[len(resource_ids) * shard['page'] // shard['pages']:len(resource_ids) * (shard['page'] + 1) // shard['pages']]
+        for resource_id in resource_ids:
+            yield(account_id, resource_id)
+
+
+def load_manifests(prefix, account_ids):
+    '''Returns {account_id: ResourceManifest}, loading them in parallel'''
+    with ThreadPoolExecutor(max_workers=COMPACTION_FETCH_WORKERS) as executor:
+        manifests = executor.map(lambda account_id: ResourceManifest(prefix, account_id), account_ids)
+        return(dict(zip(account_ids, manifests)))
+
+
+def fetch_resources(prefix, resource_ids):
+    '''
+    Takes (account_id, resource_id) pairs and yields (account_id, resource) in the same order, with None for the
+    resources that are gone. The objects are downloaded in parallel, with at most COMPACTION_FETCH_WORKERS * 4 in flight
+    so a large account isn't held in memory.
+    '''
+    with ThreadPoolExecutor(max_workers=COMPACTION_FETCH_WORKERS) as executor:
+        pending = deque()
+        for account_id, resource_id in resource_ids:
+            pending.append((account_id, executor.submit(get_resource, f"Resources/{prefix}/{resource_id}.json")))
+            if len(pending) >= COMPACTION_FETCH_WORKERS * 4:
+                account_id, future = pending.popleft()
+                yield(account_id, future.result())
+        while pending:
+            account_id, future = pending.popleft()
+            yield(account_id, future.result())
+
+
+def finish_member(writer, member, index):
+    '''Write out the end of the account's gzip member and add it to the index'''
+    if member is None:
+        return()
+    writer.write(member['compressor'].flush())
+    index['accounts'][member['account_id']] = {'offset': member['offset'], 'length': writer.size - member['offset'], 'rows': member['rows']}
+    index['rows'] += member['rows']
+
+
+def save_index(object_key, index):
+    s3_client = get_cached_client('s3')
+    s3_client.put_object(
+        Body=json.dumps(index, sort_keys=True, indent=2),
+        Bucket=os.environ['INVENTORY_BUCKET'],
+        ContentType='application/json',
+        Key=object_key,
+    )
+
+
+def get_resource(object_key):
+    '''Returns the resource in object_key, or None if it is gone'''
+    s3_client = get_cached_client('s3')
+    try:
+        response = s3_client.get_object(Bucket=os.environ['INVENTORY_BUCKET'], Key=object_key)
+        return(json.loads(response['Body'].read()))
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchKey':
+            logger.debug(f"{object_key} is in the manifest but not in S3")
+            return(None)
+        raise
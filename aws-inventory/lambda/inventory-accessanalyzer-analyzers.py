@@ -33,10 +33,7 @@ def lambda_handler(event, context):
         if 'region' in message:
             regions = [message['region']]
 
-        # describe ec2 instances
-        for r in regions:
-            client = target_account.get_client('accessanalyzer', region=r)
-            analyzer = get_analyzer(target_account, client, r)
+        for_each_region(target_account, lambda r: get_analyzer(target_account, target_account.get_client('accessanalyzer', region=r), r), regions=regions)
 
 
     except AntiopeAssumeRoleError as e:
@@ -57,6 +54,8 @@ def lambda_handler(event, context):
         logger.critical("{}\nMessage: {}\nContext: {}".format(e, message, vars(context)))
         capture_error(message, context, e, "General Exception for {}: {}".format(account_id, e))
         raise
+    finally:
+        flush_resources(message, context)
 
 
 def get_analyzer(target_account, client, region):
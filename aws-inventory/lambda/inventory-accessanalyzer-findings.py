@@ -113,7 +113,7 @@ def get_findings(delegated_account, client, region, analyzer_arn):
 
 def save_findings(findings, orgId):
     # Save HTML and json to S3
-    s3_client = boto3.client('s3')
+    s3_client = get_cached_client('s3')
     today = datetime.date.today()
 
     try:
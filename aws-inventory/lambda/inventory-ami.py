@@ -41,9 +41,9 @@ def lambda_handler(event, context):
             regions = [message['region']]
 
         # describe ec2 instances
-        for r in regions:
-            ec2_client = target_account.get_client('ec2', region=r)
-            process_instances(target_account, ec2_client, r)
+        registrar = ForeignAccountRegistrar(attributes={'ami_source': True})
+        for_each_region(target_account, lambda r: process_instances(target_account, target_account.get_client('ec2', region=r), r, registrar), regions=regions)
+        registrar.register()
 
     except AntiopeAssumeRoleError as e:
         logger.error("Unable to assume role into account {}({})".format(target_account.account_name, target_account.account_id))
@@ -56,9 +56,11 @@ def lambda_handler(event, context):
         logger.critical("{}\nMessage: {}\nContext: {}".format(e, message, vars(context)))
         capture_error(message, context, e, "General Exception for {}: {}".format(message['account_id'], e))
         raise
+    finally:
+        flush_resources(message, context)
 
 
-def process_instances(target_account, ec2_client, region):
+def process_instances(target_account, ec2_client, region, registrar):
     instance_reservations = get_all_instances(ec2_client)
     logger.debug("Found {} instance reservations for {} in {}".format(len(instance_reservations), target_account.account_id, region))
 
@@ -70,12 +72,12 @@ def process_instances(target_account, ec2_client, region):
         for instance in reservation['Instances']:
             if instance['ImageId'] not in seen_images:
                 image_id = instance['ImageId']
-                owner = process_image(target_account, ec2_client, region, image_id, seen_owners)
+                owner = process_image(target_account, ec2_client, region, image_id, seen_owners, registrar)
                 seen_images.append(image_id)
                 seen_owners.append(owner)
 
 
-def process_image(target_account, ec2_client, region, image_id, seen_owners):
+def process_image(target_account, ec2_client, region, image_id, seen_owners, registrar):
     response = ec2_client.describe_images(ImageIds=[image_id])
     # dump info about instances to S3 as json
     for image in response['Images']:
@@ -98,7 +100,7 @@ def process_image(target_account, ec2_client, region, image_id, seen_owners):
         save_resource_to_s3(RESOURCE_PATH, resource_item['resourceId'], resource_item)
 
         if image['OwnerId'] not in seen_owners:
-            process_trusted_account(image['OwnerId'])
+            registrar.add(image['OwnerId'])
 
 
 def get_all_instances(ec2_client):
@@ -109,28 +111,3 @@ def get_all_instances(ec2_client):
         response = ec2_client.describe_instances(NextToken=response['NextToken'])
     output += response['Reservations']
     return(output)
-
-
-def process_trusted_account(account_id):
-    '''Given an AWS Principal, determine if the account is known, and if not known, add to the accounts database'''
-    dynamodb = boto3.resource('dynamodb')
-    account_table = dynamodb.Table(os.environ['ACCOUNT_TABLE'])
-
-    response = account_table.get_item(
-        Key={'account_id': account_id},
-        AttributesToGet=['account_id', 'account_status'],
-        ConsistentRead=True
-    )
-    if 'Item' not in response:
-        logger.info(u"Adding foreign account {}".format(account_id))
-        try:
-            response = account_table.put_item(
-                Item={
-                    'account_id': account_id,
-                    'account_name': "unknown",
-                    'account_status': "FOREIGN",
-                    'ami_source': True
-                }
-            )
-        except ClientError as e:
-            raise AccountUpdateError(u"Unable to create {}: {}".format(a[u'Name'], e))
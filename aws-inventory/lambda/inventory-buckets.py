@@ -43,6 +43,8 @@ def lambda_handler(event, context):
         logger.critical("{}\nMessage: {}\nContext: {}".format(e, message, vars(context)))
         capture_error(message, context, e, "General Exception for {}: {}".format(message['account_id'], e))
         raise
+    finally:
+        flush_resources(message, context)
 
 
 def discover_buckets(account, context):
@@ -6,6 +6,7 @@ import os
 import time
 from datetime import datetime, timezone
 from dateutil import tz
+from dateutil.parser import isoparse
 
 from antiope.aws_account import *
 from common import *
@@ -20,6 +21,8 @@ logging.getLogger('urllib3').setLevel(logging.WARNING)
 
 RESOURCE_PATH = "cloudformation/stack"
 RESOURCE_TYPE = "AWS::CloudFormation::Stack"
+# Account table attribute holding {region: watermark}. Stacks that haven't changed since the watermark are skipped
+WATERMARK_ATTRIBUTE = "cft_watermarks"
 
 
 def lambda_handler(event, context):
@@ -29,7 +32,8 @@ def lambda_handler(event, context):
     message = json.loads(event['Records'][0]['Sns']['Message'])
     logger.info("Received message: " + json.dumps(message, sort_keys=True))
 
-    last_run_time = datetime.datetime.now(timezone.utc) - datetime.timedelta(minutes=35) # FIXME from being hardcoded time
+    # Regions that finish get their watermark moved up to when their pass started. Pass "full": true to sweep everything
+    completed = {}
 
     try:
         target_account = AWSAccount(message['account_id'])
@@ -38,13 +42,20 @@ def lambda_handler(event, context):
         if 'region' in message:
             regions = [message['region']]
 
-        for r in regions:
-            cf_client = target_account.get_client('cloudformation', region=r)
-            response = cf_client.describe_stacks()
-            while 'NextToken' in response:
-                process_stacks(target_account, cf_client, r, response['Stacks'], last_run_time)
-                response = cf_client.describe_stacks(NextToken=response['NextToken'])
-            process_stacks(target_account, cf_client, r, response['Stacks'], last_run_time)
+        if message.get('full', False):
+            watermarks = {}
+        else:
+            watermarks = get_watermarks(target_account)
+
+        def inventory_region(region):
+            completed[region] = discover_stacks(target_account, region, watermarks.get(region))
+
+        try:
+            for_each_region(target_account, inventory_region, regions=regions)
+        finally:
+            # Only once the stacks are safely in S3. Nothing is written to S3 outside this try, so this is the only flush
+            if not flush_resources(message, context):
+                save_watermarks(target_account, completed)
 
     except AntiopeAssumeRoleError as e:
         logger.error("Unable to assume role into account {}({})".format(target_account.account_name, target_account.account_id))
@@ -59,6 +70,53 @@ def lambda_handler(event, context):
         raise
 
 
+def discover_stacks(target_account, region, last_run_time):
+    '''
+    Inventory the stacks changed since last_run_time (or all of them if it is None). describe_stacks() doesn't order
+    the stacks by when they last changed, so every page is read and process_stacks() skips the unchanged ones.
+    Returns the watermark for the next run.
+    '''
+    watermark = datetime.datetime.now(timezone.utc)
+    cf_client = target_account.get_client('cloudformation', region=region)
+    response = cf_client.describe_stacks()
+    while True:
+        process_stacks(target_account, cf_client, region, response['Stacks'], last_run_time)
+        for stack in response['Stacks']:
+            # Whatever an in progress stack ends up as will have this LastUpdatedTime, so it needs looking at next time too
+            if stack['StackStatus'].endswith('_IN_PROGRESS'):
+                watermark = min(watermark, stack_changed_time(stack))
+        if 'NextToken' not in response:
+            break
+        response = cf_client.describe_stacks(NextToken=response['NextToken'])
+    return(watermark)
+
+
+def stack_changed_time(stack):
+    if 'LastUpdatedTime' in stack:
+        return(stack['LastUpdatedTime'])
+    return(stack['CreationTime'])
+
+
+def get_watermarks(target_account):
+    '''Returns {region: datetime} from the account's record'''
+    watermarks = getattr(target_account, WATERMARK_ATTRIBUTE, {})
+    return({region: isoparse(w) for region, w in watermarks.items()})
+
+
+def save_watermarks(target_account, completed):
+    '''Advance the watermark of the regions that completed, keeping the others'''
+    if not completed:
+        return()
+    watermarks = dict(getattr(target_account, WATERMARK_ATTRIBUTE, {}))
+    for region, watermark in completed.items():
+        watermarks[region] = watermark.isoformat()
+    try:
+        target_account.update_attribute(WATERMARK_ATTRIBUTE, watermarks)
+    except AccountUpdateError as e:
+        # The next run will just look further back than it needs to
+        logger.error(f"Unable to save the stack watermarks for {target_account.account_id}: {e}")
+
+
 def process_stacks(target_account, cf_client, region, stacks, last_run_time):
 
     start_time = int(time.time())
@@ -66,11 +124,7 @@ def process_stacks(target_account, cf_client, region, stacks, last_run_time):
 
     for stack in stacks:
 
-        # FIXME, support a full inventory somehow
-        if 'LastUpdatedTime' in stack and stack['LastUpdatedTime'] < last_run_time:
-            # Don't inventory what's been done before
-            continue
-        if 'LastUpdatedTime' not in stack and stack['CreationTime'] < last_run_time:
+        if last_run_time is not None and stack_changed_time(stack) < last_run_time:
             # Don't inventory what's been done before
             continue
 
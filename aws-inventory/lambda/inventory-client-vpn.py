@@ -27,21 +27,9 @@ def lambda_handler(event, context):
     try:
         target_account = AWSAccount(message['account_id'])
          
-        for r in target_account.get_regions():
-                
-            try:
-                discover_client_vpn_endpoints(target_account, r)
-                
-            except ClientError as e:
-                # Move onto next region if we get access denied. This is probably SCPs
-                if e.response['Error']['Code'] == 'AccessDeniedException':
-                    logger.error(f"AccessDeniedException for region {r} in function {context.function_name} for {target_account.account_name}({target_account.account_id})")
-                    continue
-                elif e.response['Error']['Code'] == 'UnauthorizedOperation':
-                    logger.error(f"UnauthorizedOperation for region {r} in function {context.function_name} for {target_account.account_name}({target_account.account_id})")
-                    continue
-                else:
-                    raise  # pass on to the next handler
+        # Move onto next region if we get access denied. This is probably SCPs
+        for_each_region(target_account, lambda r: discover_client_vpn_endpoints(target_account, r),
+                        skip_errors=('AccessDeniedException', 'UnauthorizedOperation'))
 
     except AntiopeAssumeRoleError as e:
         logger.error("Unable to assume role into account {}({})".format(target_account.account_name, target_account.account_id))
@@ -60,6 +48,8 @@ def lambda_handler(event, context):
         logger.critical("{}\nMessage: {}\nContext: {}".format(e, message, vars(context)))
         capture_error(message, context, e, "General Exception for {}: {}".format(message['account_id'], e))
         raise
+    finally:
+        flush_resources(message, context)
 
 def discover_client_vpn_endpoints(target_account, region):
     '''Iterate accross all regions to discover client vpn endpoints'''
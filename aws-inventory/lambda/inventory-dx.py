@@ -40,17 +40,8 @@ def lambda_handler(event, context):
         # Therefore, we query for them once, and decorate them with their VIFs as we find them in each region
         dx_gws = discover_gateways(target_account)
 
-        for r in target_account.get_regions():
-            try:
-                discover_connections(target_account, r)
-                dx_gws = discover_vifs(target_account, r, dx_gws)
-            except ClientError as e:
-                # Move onto next region if we get access denied. This is probably SCPs
-                if e.response['Error']['Code'] == 'AccessDeniedException':
-                    logger.error(f"AccessDeniedException for region {r} in function {context.function_name} for {target_account.account_name}({target_account.account_id})")
-                    continue
-                else:
-                    raise  # pass on to the next handlier
+        # discover_vifs() only appends to the per-gateway VIF lists, so the regions can share dx_gws
+        for_each_region(target_account, lambda r: discover_region(target_account, r, dx_gws))
 
         # Now save the gateways
         for gwid, resource_item in dx_gws.items():
@@ -67,6 +58,14 @@ def lambda_handler(event, context):
         logger.critical("{}\nMessage: {}\nContext: {}".format(e, message, vars(context)))
         capture_error(message, context, e, "General Exception for {}: {}".format(message['account_id'], e))
         raise
+    finally:
+        flush_resources(message, context)
+
+
+def discover_region(target_account, region, dx_gws):
+    '''Discover the DX Connections and VIFs in region'''
+    discover_connections(target_account, region)
+    discover_vifs(target_account, region, dx_gws)
 
 
 def discover_connections(target_account, region):
@@ -30,9 +30,7 @@ def lambda_handler(event, context):
 
     try:
         target_account = AWSAccount(message['account_id'])
-        for r in target_account.get_regions():
-            discover_elbv1(target_account, r)
-            discover_elbv2(target_account, r)
+        for_each_region(target_account, lambda r: discover_elbs(target_account, r))
 
     except AntiopeAssumeRoleError as e:
         logger.error("Unable to assume role into account {}({})".format(target_account.account_name, target_account.account_id))
@@ -48,6 +46,14 @@ def lambda_handler(event, context):
         logger.critical("{}\nMessage: {}\nContext: {}".format(e, message, vars(context)))
         capture_error(message, context, e, "General Exception for {}: {}".format(message['account_id'], e))
         raise
+    finally:
+        flush_resources(message, context)
+
+
+def discover_elbs(account, region):
+    '''Discover both the Classic and the v2 Loadbalancers in region'''
+    discover_elbv1(account, region)
+    discover_elbv2(account, region)
 
 
 def discover_elbv1(account, region):
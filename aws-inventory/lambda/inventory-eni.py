@@ -27,8 +27,7 @@ def lambda_handler(event, context):
 
     try:
         target_account = AWSAccount(message['account_id'])
-        for r in target_account.get_regions():
-            discover_enis(target_account, r)
+        for_each_region(target_account, lambda r: discover_enis(target_account, r))
 
     except AntiopeAssumeRoleError as e:
         logger.error("Unable to assume role into account {}({})".format(target_account.account_name, target_account.account_id))
@@ -44,6 +43,8 @@ def lambda_handler(event, context):
         logger.critical("{}\nMessage: {}\nContext: {}".format(e, message, vars(context)))
         capture_error(message, context, e, "General Exception for {}: {}".format(message['account_id'], e))
         raise
+    finally:
+        flush_resources(message, context)
 
 
 def discover_enis(account, region):
@@ -52,7 +53,7 @@ def discover_enis(account, region):
         Will Return an array of objects put in the table
 
     '''
-    s3client = boto3.client('s3')
+    s3client = get_cached_client('s3')
 
     resource_item = {}
     resource_item['awsAccountId']                   = account.account_id
@@ -75,7 +76,7 @@ def discover_enis(account, region):
     for eni in interfaces:
 
         # Don't save ENIs that already exist. They don't change much.
-        if eni_exists(RESOURCE_PATH, eni['NetworkInterfaceId'], s3client):
+        if eni_exists(RESOURCE_PATH, eni['NetworkInterfaceId'], account):
             continue
 
         resource_item['configurationItemCaptureTime']   = str(datetime.datetime.now())
@@ -100,21 +101,14 @@ def discover_enis(account, region):
             except ClientError as e:
                 logger.error("Unable to save object {}: {}".format(object_key, e))
 
-def eni_exists(path, interface_id, s3client):
-    try:
-        response = s3client.head_object(
-            Bucket=os.environ['INVENTORY_BUCKET'],
-            Key=f"Resources/{path}/{interface_id}.json"
-        )
-        if response['LastModified'] > datetime.datetime.now(timezone.utc) - datetime.timedelta(hours=15):
-            return(True)
-        else:
-            return(False)
-    except ClientError as e: # Object is missing, or othererror
+def eni_exists(path, interface_id, account):
+    last_seen = resource_writer.manifest(path, account.account_id).last_seen(interface_id)
+    if last_seen is not None and last_seen > datetime.datetime.now(timezone.utc) - datetime.timedelta(hours=15):
+        return(True)
+    else:
         return(False)
 
 
-
 def json_serial(obj):
     """JSON serializer for objects not serializable by default json code"""
 
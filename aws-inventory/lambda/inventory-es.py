@@ -34,43 +34,7 @@ def lambda_handler(event, context):
             regions = [message['region']]
 
         # describe ES Domains
-        for r in regions:
-            try:
-                es_client = target_account.get_client('es', region=r)
-
-                resource_item = {}
-                resource_item['awsAccountId']                   = target_account.account_id
-                resource_item['awsAccountName']                 = target_account.account_name
-                resource_item['resourceType']                   = RESOURCE_TYPE
-                resource_item['awsRegion']                      = r
-                resource_item['source']                         = "Antiope"
-
-                for domain_name in list_domains(es_client, target_account, r):
-                    response = es_client.describe_elasticsearch_domain(DomainName=domain_name)
-                    domain = response['DomainStatus']
-
-                    resource_item['configurationItemCaptureTime']   = str(datetime.datetime.now())
-                    resource_item['configuration']                  = domain
-                    resource_item['supplementaryConfiguration']     = {}
-                    resource_item['resourceId']                     = domain['DomainId']
-                    resource_item['resourceName']                   = domain['DomainName']
-                    resource_item['ARN']                            = domain['ARN']
-                    resource_item['errors']                         = {}
-
-                    if domain['AccessPolicies']:
-                        # The ES Domains' Access policy is returned as a string. Here we parse the json and reapply it to the dict
-                        resource_item['supplementaryConfiguration']['AccessPolicies']  = json.loads(domain['AccessPolicies'])
-
-                    object_name = "{}-{}-{}".format(domain_name, r, target_account.account_id)
-                    save_resource_to_s3(RESOURCE_PATH, object_name, resource_item)
-
-            except ClientError as e:
-                # Move onto next region if we get access denied. This is probably SCPs
-                if e.response['Error']['Code'] == 'AccessDeniedException':
-                    logger.error(f"AccessDeniedException for region {r} in function {context.function_name} for {target_account.account_name}({target_account.account_id})")
-                    continue
-                else:
-                    raise  # pass on to the next handlier
+        for_each_region(target_account, lambda r: discover_domains(target_account, r), regions=regions)
 
     except AntiopeAssumeRoleError as e:
         logger.error("Unable to assume role into account {}({})".format(target_account.account_name, target_account.account_id))
@@ -86,6 +50,39 @@ def lambda_handler(event, context):
         logger.critical("{}\nMessage: {}\nContext: {}".format(e, message, vars(context)))
         capture_error(message, context, e, "General Exception for {}: {}".format(message['account_id'], e))
         raise
+    finally:
+        flush_resources(message, context)
+
+
+def discover_domains(target_account, region):
+    '''Discover the ElasticSearch Domains in region'''
+    es_client = target_account.get_client('es', region=region)
+
+    resource_item = {}
+    resource_item['awsAccountId']                   = target_account.account_id
+    resource_item['awsAccountName']                 = target_account.account_name
+    resource_item['resourceType']                   = RESOURCE_TYPE
+    resource_item['awsRegion']                      = region
+    resource_item['source']                         = "Antiope"
+
+    for domain_name in list_domains(es_client, target_account, region):
+        response = es_client.describe_elasticsearch_domain(DomainName=domain_name)
+        domain = response['DomainStatus']
+
+        resource_item['configurationItemCaptureTime']   = str(datetime.datetime.now())
+        resource_item['configuration']                  = domain
+        resource_item['supplementaryConfiguration']     = {}
+        resource_item['resourceId']                     = domain['DomainId']
+        resource_item['resourceName']                   = domain['DomainName']
+        resource_item['ARN']                            = domain['ARN']
+        resource_item['errors']                         = {}
+
+        if domain['AccessPolicies']:
+            # The ES Domains' Access policy is returned as a string. Here we parse the json and reapply it to the dict
+            resource_item['supplementaryConfiguration']['AccessPolicies']  = json.loads(domain['AccessPolicies'])
+
+        object_name = "{}-{}-{}".format(domain_name, region, target_account.account_id)
+        save_resource_to_s3(RESOURCE_PATH, object_name, resource_item)
 
 
 def list_domains(es_client, target_account, region):
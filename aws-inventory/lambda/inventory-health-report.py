@@ -53,7 +53,7 @@ def lambda_handler(event, context):
                 data['error'] = msg
                 logger.error(msg)
 
-        s3client = boto3.client('s3')
+        s3client = get_cached_client('s3')
         s3response = s3client.put_object(
             # ACL='public-read', #FIXME
             Body=json.dumps(data, sort_keys=True, default=str, indent=2),
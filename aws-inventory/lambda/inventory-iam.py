@@ -9,6 +9,7 @@ from datetime import datetime, timezone
 from dateutil import tz
 import re
 from xml.dom.minidom import parseString
+from concurrent.futures import ThreadPoolExecutor
 
 from antiope.aws_account import *
 from common import *
@@ -24,6 +25,11 @@ USER_RESOURCE_PATH = "iam/user"
 ROLE_RESOURCE_PATH = "iam/role"
 SAML_RESOURCE_PATH = "iam/saml"
 
+# Number of times to check if the credential report has been generated
+CREDENTIAL_REPORT_ATTEMPTS = int(os.getenv('CREDENTIAL_REPORT_ATTEMPTS', default=20))
+# Per-user calls that get_account_authorization_details can't answer (MFA, access keys, login profile) run this many at a time
+IAM_MAX_WORKERS = int(os.getenv('IAM_MAX_WORKERS', default=4))
+
 
 def lambda_handler(event, context):
     logger.debug("Received event: " + json.dumps(event, sort_keys=True))
@@ -32,8 +38,11 @@ def lambda_handler(event, context):
 
     try:
         target_account = AWSAccount(message['account_id'])
-        discover_roles(target_account)
-        discover_users(target_account)
+        authorization_details = get_authorization_details(target_account)
+        registrar = ForeignAccountRegistrar()
+        discover_roles(target_account, authorization_details, registrar)
+        registrar.register()
+        discover_users(target_account, authorization_details)
         discover_saml_provider(target_account)
         fetch_credential_report(target_account, message)
 
@@ -48,9 +57,28 @@ def lambda_handler(event, context):
         logger.critical("{}\nMessage: {}\nContext: {}".format(e, message, vars(context)))
         capture_error(message, context, e, "General Exception for {}: {}".format(message['account_id'], e))
         raise
+    finally:
+        flush_resources(message, context)
+
+
+def get_authorization_details(account):
+    '''
+        Sweep get_account_authorization_details once for the whole account, rather than asking about each principal.
+        Returns {'Role': {RoleName: RoleDetail}, 'User': {UserName: UserDetail}}
+    '''
+    details = {'Role': {}, 'User': {}}
+
+    iam_client = account.get_client('iam')
+    paginator = iam_client.get_paginator('get_account_authorization_details')
+    for page in paginator.paginate(Filter=['Role', 'User']):
+        for role in page['RoleDetailList']:
+            details['Role'][role['RoleName']] = role
+        for user in page['UserDetailList']:
+            details['User'][user['UserName']] = user
+    return(details)
 
 
-def discover_roles(account):
+def discover_roles(account, authorization_details, registrar):
     '''
         Discovers all IAM Roles. If there is a trust relationship to an external account it will note that.
     '''
@@ -64,18 +92,10 @@ def discover_roles(account):
     roles += response['Roles']
 
     for role in roles:
-        try:
-            process_role(role, account, iam_client)
-        except ClientError as e:
-            if e.response['Error']['Code'] == "Throttling":
-                logger.error(f"Hit a Throttling Exception {e}")
-                time.sleep(1)
-                process_role(role, account, iam_client)
-            else:
-                raise
+        process_role(role, account, iam_client, authorization_details['Role'].get(role['RoleName']), registrar)
 
 
-def process_role(role, account, iam_client):
+def process_role(role, account, iam_client, role_detail, registrar):
 
     resource_item = {}
     resource_item['awsAccountId']                   = account.account_id
@@ -94,11 +114,20 @@ def process_role(role, account, iam_client):
     resource_item['errors']                         = {}
 
     # Fetch the policies attached to this role
-    response = iam_client.list_role_policies(RoleName=role['RoleName']) # FIXME Paganation can occur.
-    resource_item['supplementaryConfiguration']['PolicyNames'] = response['PolicyNames']
+    if role_detail is not None:
+        resource_item['supplementaryConfiguration']['PolicyNames'] = [p['PolicyName'] for p in role_detail['RolePolicyList']]
+        resource_item['supplementaryConfiguration']['AttachedPolicies'] = role_detail['AttachedManagedPolicies']
+    else:
+        # Role was created after the authorization details sweep, ask about it directly
+        policy_names = []
+        for page in iam_client.get_paginator('list_role_policies').paginate(RoleName=role['RoleName']):
+            policy_names += page['PolicyNames']
+        resource_item['supplementaryConfiguration']['PolicyNames'] = policy_names
 
-    response = iam_client.list_attached_role_policies(RoleName=role['RoleName']) # FIXME Paganation can occur.
-    resource_item['supplementaryConfiguration']['AttachedPolicies'] = response['AttachedPolicies']
+        attached_policies = []
+        for page in iam_client.get_paginator('list_attached_role_policies').paginate(RoleName=role['RoleName']):
+            attached_policies += page['AttachedPolicies']
+        resource_item['supplementaryConfiguration']['AttachedPolicies'] = attached_policies
 
     save_resource_to_s3(ROLE_RESOURCE_PATH, resource_item['resourceId'], resource_item)
 
@@ -112,48 +141,12 @@ def process_role(role, account, iam_client):
         elif 'AWS' in s['Principal']:  # This means it's trusting an AWS Account and not an AWS Service.
             if type(s['Principal']['AWS']) is list:
                 for p in s['Principal']['AWS']:
-                    process_trusted_account(p, role['Arn'])
+                    registrar.add(p, role['Arn'])
             else:
-                process_trusted_account(s['Principal']['AWS'], role['Arn'])
-
-
-def process_trusted_account(principal, role_arn):
-    '''Given an AWS Principal, determine if the account is known, and if not known, add to the accounts database'''
-    dynamodb = boto3.resource('dynamodb')
-    account_table = dynamodb.Table(os.environ['ACCOUNT_TABLE'])
-
-    # Principals can be an ARN, or just an account ID.
-    if principal.startswith("arn"):
-        account_id = principal.split(':')[4]
-    elif re.match('^[0-9]{12}$', principal):
-        account_id = principal
-    elif principal == "*":
-        logger.error("Found an assume role policy that trusts everything!!!: {}".format(role_arn))
-        return()  # No accounts to add to the DB
-    else:
-        logger.error("Unable to identify what kind of AWS Principal this is: {}".format(principal))
-        return()
-
-    response = account_table.get_item(
-        Key={'account_id': account_id},
-        AttributesToGet=['account_id', 'account_status'],
-        ConsistentRead=True
-    )
-    if 'Item' not in response:
-        logger.info(u"Adding foreign account {}".format(account_id))
-        try:
-            response = account_table.put_item(
-                Item={
-                    'account_id':       account_id,
-                    'account_name':     "unknown",
-                    'account_status':   "FOREIGN",
-                }
-            )
-        except ClientError as e:
-            raise AccountUpdateError(u"Unable to create {}: {}".format(a[u'Name'], e))
+                registrar.add(s['Principal']['AWS'], role['Arn'])
 
 
-def discover_users(account):
+def discover_users(account, authorization_details):
     '''
         Queries AWS to determine IAM Users exist in an AWS Account
     '''
@@ -166,43 +159,59 @@ def discover_users(account):
         response = iam_client.list_users(Marker=response['Marker'])
     users += response['Users']
 
+    # MFA, Access Keys and Login Profiles aren't in the authorization details, so those are still per-user calls
+    with ThreadPoolExecutor(max_workers=IAM_MAX_WORKERS) as executor:
+        credentials = list(executor.map(lambda u: get_user_credentials(iam_client, u['UserName']), users))
+
     resource_item = {}
     resource_item['awsAccountId']                   = account.account_id
     resource_item['awsAccountName']                 = account.account_name
     resource_item['resourceType']                   = "AWS::IAM::User"
     resource_item['source']                         = "Antiope"
 
-    for user in users:
+    for user, user_credentials in zip(users, credentials):
         resource_item['configurationItemCaptureTime']   = str(datetime.datetime.now())
         resource_item['configuration']                  = user
         if 'Tags' in user:
             resource_item['tags']                           = parse_tags(user['Tags'])
-        resource_item['supplementaryConfiguration']     = {}
+        resource_item['supplementaryConfiguration']     = user_credentials
         resource_item['resourceId']                     = user['UserId']
         resource_item['resourceName']                   = user['UserName']
         resource_item['ARN']                            = user['Arn']
         resource_item['resourceCreationTime']           = user['CreateDate']
         resource_item['errors']                         = {}
 
-        response = iam_client.list_mfa_devices(UserName=user['UserName'])
-        if 'MFADevices' in response and len(response['MFADevices']) > 0:
-            resource_item['supplementaryConfiguration']['MFADevice'] = response['MFADevices'][0]
+        user_detail = authorization_details['User'].get(user['UserName'])
+        if user_detail is not None:
+            resource_item['supplementaryConfiguration']['Groups'] = user_detail['GroupList']
+            resource_item['supplementaryConfiguration']['PolicyNames'] = [p['PolicyName'] for p in user_detail['UserPolicyList']]
+            resource_item['supplementaryConfiguration']['AttachedPolicies'] = user_detail['AttachedManagedPolicies']
 
-        response = iam_client.list_access_keys(UserName=user['UserName'])
-        if 'AccessKeyMetadata' in response and len(response['AccessKeyMetadata']) > 0:
-            resource_item['supplementaryConfiguration']['AccessKeyMetadata'] = response['AccessKeyMetadata']
+        save_resource_to_s3(USER_RESOURCE_PATH, resource_item['resourceId'], resource_item)
 
-        try:
-            response = iam_client.get_login_profile(UserName=user['UserName'])
-            if 'LoginProfile' in response:
-                resource_item['supplementaryConfiguration']['LoginProfile'] = response["LoginProfile"]
-        except ClientError as e:
-            if e.response['Error']['Code'] == "NoSuchEntity":
-                pass
-            else:
-                raise
 
-        save_resource_to_s3(USER_RESOURCE_PATH, resource_item['resourceId'], resource_item)
+def get_user_credentials(iam_client, user_name):
+    '''Return the supplementaryConfiguration for the user's MFA Device, Access Keys and Login Profile'''
+    output = {}
+
+    response = iam_client.list_mfa_devices(UserName=user_name)
+    if 'MFADevices' in response and len(response['MFADevices']) > 0:
+        output['MFADevice'] = response['MFADevices'][0]
+
+    response = iam_client.list_access_keys(UserName=user_name)
+    if 'AccessKeyMetadata' in response and len(response['AccessKeyMetadata']) > 0:
+        output['AccessKeyMetadata'] = response['AccessKeyMetadata']
+
+    try:
+        response = iam_client.get_login_profile(UserName=user_name)
+        if 'LoginProfile' in response:
+            output['LoginProfile'] = response["LoginProfile"]
+    except ClientError as e:
+        if e.response['Error']['Code'] == "NoSuchEntity":
+            pass
+        else:
+            raise
+    return(output)
 
 
 def discover_saml_provider(account):
@@ -248,7 +257,7 @@ def fetch_credential_report(account, event):
     csv_data = get_credential_report(iam_client)
     object_key = f"CredentialReports/{account.account_id}-{event['timestamp']}.csv"
 
-    s3_client = boto3.client('s3')
+    s3_client = get_cached_client('s3')
     try:
         response = s3_client.put_object(
             # ACL='public-read',
@@ -263,46 +272,24 @@ def fetch_credential_report(account, event):
 
 
 def get_credential_report(iam_client):
-    '''Fetches the credential report. Uses recursion in case the report isn't available immediatly'''
-
-    # Lets see if a report is already available
-    try:
-        response = iam_client.get_credential_report()
-        credential_report_csv = response['Content'].decode('ascii')
-        return(credential_report_csv)
-    except ClientError as e:
-        if e.response['Error']['Code'] == "ReportNotPresent":
-            pass
-        elif e.response['Error']['Code'] == "ReportInProgress":
-            time.sleep(2)
-            return get_credential_report(iam_client)
-        else:
-            raise  # Whatever happened here we didn't expect
-
-    try:
-        # No report - go request one get generated
-        resp1 = iam_client.generate_credential_report()
-        if resp1['State'] == 'COMPLETE':
-            try:
-                response = iam_client.get_credential_report()
-                credential_report_csv = response['Content'].decode('ascii')
-                # # print(credential_report_csv)
-                # reader = csv.DictReader(credential_report_csv.splitlines())
-                # # print(reader)
-                # # print(reader.fieldnames)
-                # credential_report = []
-                # for row in reader:
-                #     credential_report.append(row)
-                return(credential_report_csv)
-            except ClientError as e:
-                print("Unknown error getting Report: " + e.message)
-        else:
-            time.sleep(2)
-            return get_credential_report(iam_client)
-    except ClientError as e:
-        if e.response['Error']['Code'] == "Throttling":
-            time.sleep(2)
-            return get_credential_report(iam_client)
-        else:
-            raise
+    '''
+    Fetches the credential report, asking IAM to generate one if there isn't one available.
+    Throttling is retried by the client, so the only waiting here is for the report to be generated.
+    '''
+    delay = 0.5
+    for attempt in range(CREDENTIAL_REPORT_ATTEMPTS):
+        try:
+            response = iam_client.get_credential_report()
+            return(response['Content'].decode('ascii'))
+        except ClientError as e:
+            if e.response['Error']['Code'] == "ReportNotPresent":
+                # No report - go request one get generated
+                if iam_client.generate_credential_report()['State'] == 'COMPLETE':
+                    continue
+            elif e.response['Error']['Code'] != "ReportInProgress":
+                raise  # Whatever happened here we didn't expect
+        # Report generation usually takes a few seconds, so poll quickly at first
+        time.sleep(delay)
+        delay = min(delay * 2, 4)
+    raise Exception(f"Credential report still not ready after {CREDENTIAL_REPORT_ATTEMPTS} attempts")
 
@@ -32,19 +32,7 @@ def lambda_handler(event, context):
             regions = [message['region']]
 
         # describe ec2 instances
-        for r in regions:
-            try:
-                ec2_client = target_account.get_client('ec2', region=r)
-                process_instances(target_account, ec2_client, r)
-                # describe ec2 security groups
-                process_securitygroups(target_account, ec2_client, r)
-            except ClientError as e:
-                # Move onto next region if we get access denied. This is probably SCPs
-                if e.response['Error']['Code'] == 'AccessDeniedException':
-                    logger.error(f"AccessDeniedException for region {r} in function {context.function_name} for {target_account.account_name}({target_account.account_id})")
-                    continue
-                else:
-                    raise  # pass on to the next handlier
+        for_each_region(target_account, lambda r: discover_region(target_account, r), regions=regions)
 
     except AntiopeAssumeRoleError as e:
         logger.error("Unable to assume role into account {}({})".format(target_account.account_name, target_account.account_id))
@@ -57,6 +45,16 @@ def lambda_handler(event, context):
         logger.critical("{}\nMessage: {}\nContext: {}".format(e, message, vars(context)))
         capture_error(message, context, e, "General Exception for {}: {}".format(message['account_id'], e))
         raise
+    finally:
+        flush_resources(message, context)
+
+
+def discover_region(target_account, region):
+    '''Inventory the EC2 Instances and Security Groups in region'''
+    ec2_client = target_account.get_client('ec2', region=region)
+    process_instances(target_account, ec2_client, region)
+    # describe ec2 security groups
+    process_securitygroups(target_account, ec2_client, region)
 
 
 def process_instances(target_account, ec2_client, region):
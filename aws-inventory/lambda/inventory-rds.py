@@ -28,9 +28,7 @@ def lambda_handler(event, context):
 
     try:
         target_account = AWSAccount(message['account_id'])
-        for r in target_account.get_regions():
-            discover_rds(target_account, r)
-            discover_aurora(target_account, r)
+        for_each_region(target_account, lambda r: discover_databases(target_account, r))
 
     except AntiopeAssumeRoleError as e:
         logger.error("Unable to assume role into account {}({})".format(target_account.account_name, target_account.account_id))
@@ -46,6 +44,14 @@ def lambda_handler(event, context):
         logger.critical("{}\nMessage: {}\nContext: {}".format(e, message, vars(context)))
         capture_error(message, context, e, "General Exception for {}: {}".format(message['account_id'], e))
         raise
+    finally:
+        flush_resources(message, context)
+
+
+def discover_databases(account, region):
+    '''Discover both the RDS Instances and the Aurora Clusters in region'''
+    discover_rds(account, region)
+    discover_aurora(account, region)
 
 
 def discover_rds(account, region):
@@ -19,16 +19,34 @@ logging.getLogger('urllib3').setLevel(logging.WARNING)
 DOMAIN_RESOURCE_PATH = "route53/domain"
 ZONE_RESOURCE_PATH = "route53/hostedzone"
 
+# Each zone's record sets are saved as a JSON list to their own object. They're kept out of Resources/ so a
+# zone with thousands of records isn't sent to the search cluster as one document.
+RECORD_SET_PATH = "Route53RecordSets"
+# S3 user metadata key the zone's ResourceRecordSetCount is stored under. Zones with the same count are skipped,
+# unless their record sets are older than RECORD_SET_MAX_AGE seconds (a changed value or TTL doesn't change the count)
+RECORD_COUNT_METADATA = 'antiope-record-count'
+RECORD_SET_MAX_AGE = int(os.getenv('ROUTE53_RECORD_SET_MAX_AGE', default=86400))
+# Seconds left in the invocation when the zones still to be listed are handed off to a new invocation.
+# Only one invocation per account lists record sets at a time, so they all stay within the account's 5 req/s.
+CONTINUATION_TIME_MARGIN = int(os.getenv('ROUTE53_CONTINUATION_TIME_MARGIN', default=30))
+# The handed off queue goes to Route53Continuations/{account_id}.json and the new invocation is only told the key.
+# A few thousand zones would be over the 256KB limit on an async invoke's payload.
+CONTINUATION_PATH = "Route53Continuations"
+# Minimum size of every part but the last in an S3 multipart upload
+RECORD_SET_PART_SIZE = 5 * 1024 * 1024
+
 
 def lambda_handler(event, context):
     logger.debug("Received event: " + json.dumps(event, sort_keys=True))
+    if 'route53_continuation' in event:
+        return(continue_zones(event['route53_continuation'], context))
     message = json.loads(event['Records'][0]['Sns']['Message'])
     logger.info("Received message: " + json.dumps(message, sort_keys=True))
 
     try:
         target_account = AWSAccount(message['account_id'])
         discover_domains(target_account)
-        discover_zones(target_account)
+        discover_zones(target_account, context)
 
     except AntiopeAssumeRoleError as e:
         logger.error("Unable to assume role into account {}({})".format(target_account.account_name, target_account.account_id))
@@ -41,6 +59,8 @@ def lambda_handler(event, context):
         logger.critical("{}\nMessage: {}\nContext: {}".format(e, message, vars(context)))
         capture_error(message, context, e, "General Exception for {}: {}".format(message['account_id'], e))
         raise
+    finally:
+        flush_resources(message, context)
 
 
 def discover_domains(account):
@@ -53,25 +73,11 @@ def discover_domains(account):
     # All results are saved to S3. Public IPs and metadata go to DDB (based on the the presense of PublicIp in the Association)
     route53_client = account.get_client('route53domains', region="us-east-1")  # Route53 Domains is only available in us-east-1
 
-    try:
-        response = route53_client.list_domains()
-    except ClientError as e:
-        if e.response['Error']['Code'] == 'ThrottlingException':
-            time.sleep(1)
-            response = route53_client.list_domains()
-        else:
-            raise
-
+    # Route53 has a very low API limit. get_client() paces the calls and retries the throttled ones
+    response = route53_client.list_domains()
     while 'NextPageMarker' in response:  # Gotta Catch 'em all!
         domains += response['Domains']
-        try:
-            response = route53_client.list_domains(Marker=response['NextPageMarker'])
-        except ClientError as e:
-            if e.response['Error']['Code'] == 'ThrottlingException':
-                time.sleep(1)
-                response = route53_client.list_domains(Marker=response['NextPageMarker'])
-            else:
-                raise
+        response = route53_client.list_domains(Marker=response['NextPageMarker'])
 
     domains += response['Domains']
 
@@ -107,10 +113,9 @@ def discover_domains(account):
 
         # Need to make sure the resource name is unique and service identifiable.
         save_resource_to_s3(DOMAIN_RESOURCE_PATH, resource_item['resourceId'], resource_item)
-        time.sleep(1) # To avoid throttling issues
 
 
-def discover_zones(account):
+def discover_zones(account, context):
     '''
         Queries AWS to determine what Route53 Zones are hosted in an AWS Account
     '''
@@ -120,38 +125,26 @@ def discover_zones(account):
     # All results are saved to S3. Public IPs and metadata go to DDB (based on the the presense of PublicIp in the Association)
     route53_client = account.get_client('route53')
 
-    # Route53 Describe calls have a very low API limit
-    try:
-        response = route53_client.list_hosted_zones()
-    except ClientError as e:
-        if e.response['Error']['Code'] == 'ThrottlingException':
-            time.sleep(1)
-            response = route53_client.list_hosted_zones()
-        else:
-            raise
-
+    # Route53 Describe calls have a very low API limit. get_client() paces the calls and retries the throttled ones
+    response = route53_client.list_hosted_zones()
+    zones += response['HostedZones']
     while 'IsTruncated' in response and response['IsTruncated'] is True:  # Gotta Catch 'em all!
+        response = route53_client.list_hosted_zones(Marker=response['NextMarker'])
+        zones += response['HostedZones']
 
-        # Process this batch
-        for zone in response['HostedZones']:
-            process_zone(zone, account, route53_client)
-
-        # Try and get some more
-        try:
-            response = route53_client.list_hosted_zones(Marker=response['NextMarker'])
-        except ClientError as e:
-            if e.response['Error']['Code'] == 'ThrottlingException':
-                time.sleep(1)
-                response = route53_client.list_hosted_zones(Marker=response['NextMarker'])
-            else:
-                raise
-
-    # Finish Up
-    for zone in response['HostedZones']:
-        process_zone(zone, account, route53_client)
+    # Save the zones, and then the record sets of the ones that need it. Smallest first, so if we run out of time
+    # it's the big zones that go to the continuation.
+    record_queue = []
+    for zone in zones:
+        zone_records = process_zone(zone, account, route53_client)
+        if zone_records is not None:
+            record_queue.append(zone_records)
+    record_queue.sort(key=lambda z: z['record_count'])
+    save_zone_queue({'account_id': account.account_id, 'zones': record_queue}, route53_client, context)
 
 
 def process_zone(zone, account, route53_client):
+    '''Save the zone. Returns what save_resource_records() needs to save its record sets, or None if they're current'''
 
     resource_item = {}
     resource_item['awsAccountId']                   = account.account_id
@@ -182,29 +175,195 @@ def process_zone(zone, account, route53_client):
     if 'VPCs' in response:
         resource_item['supplementaryConfiguration']['AuthorizedVPCs'] = response['VPCs']
 
-    # This currently overloads the Route53 API Limits and exceeds Lambda Timeouts.
-    # resource_item['supplementaryConfiguration']['ResourceRecordSets'] = get_resource_records(route53_client, zone['Id'])
-    # resource_item['supplementaryConfiguration']['ResourceRecordSetCount'] = len(resource_item['supplementaryConfiguration']['ResourceRecordSets'])
+    # The record sets are streamed to their own object, rather than added to the zone
+    record_key = f"{RECORD_SET_PATH}/{account.account_id}/{resource_item['resourceId']}.json"
+    resource_item['supplementaryConfiguration']['ResourceRecordSetsKey'] = record_key
 
     save_resource_to_s3(ZONE_RESOURCE_PATH, resource_item['resourceId'], resource_item)
 
+    record_count = zone.get('ResourceRecordSetCount', 0)
+    if record_sets_are_current(record_key, record_count):
+        logger.debug(f"{zone['Name']} still has {record_count} record sets, skipping them")
+        return(None)
+    return({'zone_id': zone['Id'], 'record_key': record_key, 'record_count': record_count})
+
+
+def record_sets_are_current(record_key, record_count):
+    '''True if the zone's record sets were saved with this ResourceRecordSetCount less than RECORD_SET_MAX_AGE ago'''
+    s3_client = get_cached_client('s3')
+    try:
+        response = s3_client.head_object(Bucket=os.environ['INVENTORY_BUCKET'], Key=record_key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ['404', 'NoSuchKey']:
+            return(False)
+        raise
+    age = (datetime.datetime.now(timezone.utc) - response['LastModified']).total_seconds()
+    return(response['Metadata'].get(RECORD_COUNT_METADATA) == str(record_count) and age < RECORD_SET_MAX_AGE)
+
+
+def save_zone_queue(continuation, route53_client, context):
+    '''
+    Save the record sets of each zone in continuation['zones'], handing what's left to a new invocation if we run out
+    of time. Returns True if every zone was saved, False if they were handed off.
+    '''
+    zones = continuation['zones']
+    while zones:
+        if not save_resource_records(zones[0], route53_client, context):
+            logger.info(f"Running out of time with {len(zones)} zones left, handing them off")
+            try:
+                start_continuation(continuation, context)
+            except Exception:
+                # Nothing is going to resume the upload, so don't leave its parts in the bucket
+                if 'upload' in zones[0]:
+                    RecordSetWriter(zones[0]['record_key'], zones[0]['record_count'], zones[0]['upload']).abort()
+                raise
+            return(False)
+        zones.pop(0)
+    return(True)
+
 
-def get_resource_records(route53_client, hostedzone_id):
+def save_resource_records(zone_records, route53_client, context):
+    '''
+    Streams the zone's record sets to S3 a page at a time. Returns True once they are saved, or False if the invocation
+    is running out of time, in which case zone_records['upload'] has what the next invocation needs to carry on.
+    '''
     # Route 53 Resource Limits: https://docs.aws.amazon.com/Route53/latest/DeveloperGuide/DNSLimitations.html#limits-api-requests-route-53
-    # Maxitems can be 1000, frequency is hardlimited to 5 reqs per sec. Antiope will sleep 1 between calls
+    # Maxitems can be 1000, frequency is hardlimited to 5 reqs per sec, which the client's rate limiter enforces
+    if context.get_remaining_time_in_millis() < CONTINUATION_TIME_MARGIN * 1000:
+        return(False)
+    writer = RecordSetWriter(zone_records['record_key'], zone_records['record_count'], zone_records.get('upload'))
+    try:
+        position = writer.position
+        while True:
+            if context.get_remaining_time_in_millis() < CONTINUATION_TIME_MARGIN * 1000:
+                zone_records['upload'] = writer.state()
+                logger.info(f"{writer.written} record sets of {zone_records['zone_id']} saved so far")
+                return(False)
+            response = route53_client.list_resource_record_sets(HostedZoneId=zone_records['zone_id'], MaxItems="1000", **position)
+            position = {}
+            for start_key, next_key in [('StartRecordName', 'NextRecordName'), ('StartRecordType', 'NextRecordType'), ('StartRecordIdentifier', 'NextRecordIdentifier')]:
+                if next_key in response:
+                    position[start_key] = response[next_key]
+            writer.add_page(response['ResourceRecordSets'], position)
+            if not response['IsTruncated']:
+                writer.close()
+                return(True)
+    except Exception:
+        writer.abort()
+        raise
+
 
-    rr_set = []
-    response = route53_client.list_resource_record_sets(
-        HostedZoneId=hostedzone_id,
-        MaxItems="1000"
+def start_continuation(continuation, context):
+    '''Save the continuation to S3 and asynchronously invoke this function to carry on with the zones left in it'''
+    object_key = f"{CONTINUATION_PATH}/{continuation['account_id']}.json"
+    s3_client = get_cached_client('s3')
+    s3_client.put_object(
+        Body=json.dumps(continuation, sort_keys=True),
+        Bucket=os.environ['INVENTORY_BUCKET'],
+        ContentType='application/json',
+        Key=object_key,
+    )
+    lambda_client = get_cached_client('lambda')
+    lambda_client.invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType='Event',
+        Payload=json.dumps({'route53_continuation': object_key}).encode('utf-8')
     )
-    while response['IsTruncated']:
-        rr_set += response['ResourceRecordSets']
-        time.sleep(1)
-        response = route53_client.list_resource_record_sets(
-            HostedZoneId=hostedzone_id,
-            MaxItems="1000",
-            StartRecordName=response['NextRecordName']
-        )
-    rr_set += response['ResourceRecordSets']
-    return(rr_set)
+
+
+def continue_zones(object_key, context):
+    '''Entry point for an invocation started by start_continuation(). object_key is where the continuation was saved'''
+    logger.info(f"Continuing from {object_key}")
+    event = {'route53_continuation': object_key}
+    s3_client = get_cached_client('s3')
+    try:
+        try:
+            response = s3_client.get_object(Bucket=os.environ['INVENTORY_BUCKET'], Key=object_key)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchKey':
+                raise
+            # Lambda retried an invocation that had already finished the queue
+            logger.warning(f"{object_key} is gone, nothing left to continue")
+            return()
+        continuation = json.loads(response['Body'].read())
+        logger.info(f"{len(continuation['zones'])} zones left in {continuation['account_id']}")
+
+        target_account = AWSAccount(continuation['account_id'])
+        route53_client = target_account.get_client('route53')
+        # If it was handed off again, start_continuation() has already replaced the object with what's left
+        if save_zone_queue(continuation, route53_client, context):
+            s3_client.delete_object(Bucket=os.environ['INVENTORY_BUCKET'], Key=object_key)
+
+    except AntiopeAssumeRoleError as e:
+        logger.error("Unable to assume role into account {}({})".format(target_account.account_name, target_account.account_id))
+        return()
+    except ClientError as e:
+        logger.critical("AWS Error continuing from {}: {}".format(object_key, e))
+        capture_error(event, context, e, "ClientError for {}: {}".format(object_key, e))
+        raise
+    except Exception as e:
+        logger.critical("{}\nContinuation: {}\nContext: {}".format(e, object_key, vars(context)))
+        capture_error(event, context, e, "General Exception for {}: {}".format(object_key, e))
+        raise
+
+
+class RecordSetWriter(object):
+    """
+    Writes a zone's record sets into one S3 object as a JSON list, using a multipart upload.
+    Records are buffered until there is a full part to upload. position is the list_resource_record_sets marker for the
+    first record not in an uploaded part, so another invocation can resume the upload from state() by listing from there.
+    """
+
+    def __init__(self, object_key, record_count, state=None):
+        self.s3_client = get_cached_client('s3')
+        self.bucket = os.environ['INVENTORY_BUCKET']
+        self.object_key = object_key
+        self.buffer = []
+        self.buffer_size = 0
+        if state is None:
+            response = self.s3_client.create_multipart_upload(Bucket=self.bucket, Key=object_key, ContentType='application/json',
+                                                              Metadata={RECORD_COUNT_METADATA: str(record_count)})
+            state = {'UploadId': response['UploadId'], 'Parts': [], 'Position': {}, 'Written': 0}
+        self.upload_id = state['UploadId']
+        self.parts = state['Parts']
+        self.position = state['Position']
+        self.written = state['Written']
+
+    def state(self):
+        """The unbuffered records are dropped, they're listed again from position"""
+        return({'UploadId': self.upload_id, 'Parts': self.parts, 'Position': self.position, 'Written': self.written})
+
+    def add_page(self, records, next_position):
+        for record in records:
+            body = json.dumps(record, default=str)
+            self.buffer.append(body)
+            self.buffer_size += len(body) + 1
+        if self.buffer_size >= RECORD_SET_PART_SIZE:
+            self.upload_part(self.list_body())
+            self.position = next_position
+
+    def list_body(self, last=False):
+        """The buffered records, with the opening bracket or comma that goes before them"""
+        body = ("," if self.written else "[") + ",".join(self.buffer) if self.buffer else ("" if self.written else "[")
+        self.written += len(self.buffer)
+        self.buffer = []
+        self.buffer_size = 0
+        return(body + "]" if last else body)
+
+    def upload_part(self, body):
+        part_number = len(self.parts) + 1
+        response = self.s3_client.upload_part(Bucket=self.bucket, Key=self.object_key, UploadId=self.upload_id,
+                                              PartNumber=part_number, Body=body.encode('utf-8'))
+        self.parts.append({'PartNumber': part_number, 'ETag': response['ETag']})
+
+    def close(self):
+        self.upload_part(self.list_body(last=True))
+        self.s3_client.complete_multipart_upload(Bucket=self.bucket, Key=self.object_key, UploadId=self.upload_id,
+                                                 MultipartUpload={'Parts': self.parts})
+        logger.debug(f"Saved {self.written} record sets to {self.object_key}")
+
+    def abort(self):
+        try:
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.object_key, UploadId=self.upload_id)
+        except ClientError as e:
+            logger.error(f"Unable to abort the upload of {self.object_key}: {e}")
@@ -32,17 +32,7 @@ def lambda_handler(event, context):
             regions = [message['region']]
 
         # describe ec2 instances
-        for r in regions:
-            try:
-                client = target_account.get_client('ssm', region=r)
-                process_instances(target_account, client, r)
-            except ClientError as e:
-                # Move onto next region if we get access denied. This is probably SCPs
-                if e.response['Error']['Code'] == 'AccessDeniedException':
-                    logger.error(f"AccessDeniedException for region {r} in function {context.function_name} for {target_account.account_name}({target_account.account_id})")
-                    continue
-                else:
-                    raise  # pass on to the next handlier
+        for_each_region(target_account, lambda r: process_instances(target_account, target_account.get_client('ssm', region=r), r), regions=regions)
 
     except AntiopeAssumeRoleError as e:
         logger.error("Unable to assume role into account {}({})".format(target_account.account_name, target_account.account_id))
@@ -58,6 +48,8 @@ def lambda_handler(event, context):
         logger.critical("{}\nMessage: {}\nContext: {}".format(e, message, vars(context)))
         capture_error(message, context, e, "General Exception for {}: {}".format(message['account_id'], e))
         raise
+    finally:
+        flush_resources(message, context)
 
 
 def process_instances(target_account, client, region):
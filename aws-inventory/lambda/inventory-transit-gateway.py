@@ -27,16 +27,7 @@ def lambda_handler(event, context):
     try:
         target_account = AWSAccount(message['account_id'])
             
-        for r in target_account.get_regions():
-            try:
-                discover_transit_gateways(target_account, r)
-            except ClientError as e:
-                # Move onto next region if we get access denied. This is probably SCPs
-                if e.response['Error']['Code'] == 'AccessDeniedException':
-                    logger.error(f"AccessDeniedException for region {r} in function {context.function_name} for {target_account.account_name}({target_account.account_id})")
-                    continue
-                else:
-                    raise  # pass on to the next handler
+        for_each_region(target_account, lambda r: discover_transit_gateways(target_account, r))
 
     except AntiopeAssumeRoleError as e:
         logger.error("Unable to assume role into account {}({})".format(target_account.account_name, target_account.account_id))
@@ -52,6 +43,8 @@ def lambda_handler(event, context):
         logger.critical("{}\nMessage: {}\nContext: {}".format(e, message, vars(context)))
         capture_error(message, context, e, "General Exception for {}: {}".format(message['account_id'], e))
         raise
+    finally:
+        flush_resources(message, context)
 
 def discover_transit_gateways(target_account, region):
     '''Iterate accross all regions to discover transit gateways'''
@@ -57,6 +57,8 @@ def lambda_handler(event, context):
         logger.critical("{}\nMessage: {}\nContext: {}".format(e, message, vars(context)))
         capture_error(message, context, e, "General Exception for {}: {}".format(message['account_id'], e))
         raise
+    finally:
+        flush_resources(message, context)
 
 
 def get_checks(target_account, client):
@@ -86,7 +88,7 @@ def process_ta_check(target_account, client, c):
         return()
 
     # Don't save ENIs that already exist. They don't change much.
-    if check_exists(RESOURCE_PATH, check['checkId']):
+    if check_exists(RESOURCE_PATH, target_account, check['checkId']):
         return()
 
 
@@ -106,16 +108,10 @@ def process_ta_check(target_account, client, c):
 
     save_resource_to_s3(RESOURCE_PATH, f"{target_account.account_id}-{check['checkId']}", resource_item)
 
-def check_exists(path, check_id):
-    s3client = boto3.client('s3')
-    try:
-        response = s3client.head_object(
-            Bucket=os.environ['INVENTORY_BUCKET'],
-            Key=f"Resources/{path}/{check_id}.json"
-        )
-        if response['LastModified'] > datetime.datetime.now(timezone.utc) - datetime.timedelta(hours=15):
-            return(True)
-        else:
-            return(False)
-    except ClientError as e: # Object is missing, or othererror
+def check_exists(path, target_account, check_id):
+    manifest = resource_writer.manifest(path, target_account.account_id)
+    last_seen = manifest.last_seen(f"{target_account.account_id}-{check_id}")
+    if last_seen is not None and last_seen > datetime.datetime.now(timezone.utc) - datetime.timedelta(hours=15):
+        return(True)
+    else:
         return(False)
@@ -28,23 +28,7 @@ def lambda_handler(event, context):
                     
         target_account = AWSAccount(message['account_id'])
                 
-        for r in target_account.get_regions():
-        
-            try:
-                discover_worklink_fleets(target_account, r)
-    
-            except ClientError as e:
-                # Move onto next region if we get access denied. This is probably SCPs.
-                if e.response['Error']['Code'] == 'AccessDeniedException':
-                    logger.error(f"AccessDeniedException for region {r} in function {context.function_name} for {target_account.account_name}({target_account.account_id})")
-                    continue
-                else:
-                    raise
-        
-            except EndpointConnectionError as e:
-                # Move onto next region if we get an endpoint connection error.  This is probably due to the region not being supported.
-                logger.error(f"EndpointConnectionError for region {r} in function {context.function_name} for {target_account.account_name}({target_account.account_id})")
-                continue
+        for_each_region(target_account, lambda r: discover_region(target_account, r))
        
     except AntiopeAssumeRoleError as e:
         logger.error("Unable to assume role into account {}({})".format(target_account.account_name, target_account.account_id))
@@ -63,7 +47,19 @@ def lambda_handler(event, context):
         logger.critical("{}\nMessage: {}\nContext: {}".format(e, message, vars(context)))
         capture_error(message, context, e, "General Exception for {}: {}".format(message['account_id'], e))
         raise
-    
+    finally:
+        flush_resources(message, context)
+
+
+def discover_region(target_account, region):
+    '''Discover the worklink fleets in region, skipping the regions worklink isn't in'''
+    try:
+        discover_worklink_fleets(target_account, region)
+    except EndpointConnectionError as e:
+        # Move onto next region if we get an endpoint connection error.  This is probably due to the region not being supported.
+        logger.error(f"EndpointConnectionError for region {region} for {target_account.account_name}({target_account.account_id})")
+
+
 def discover_worklink_fleets(target_account, region):
     '''Iterate accross all regions to discover worklink fleets'''
     
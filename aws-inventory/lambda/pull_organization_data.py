@@ -4,6 +4,8 @@ import json
 import os
 import time
 import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from antiope.aws_account import *
 from common import *
@@ -15,6 +17,10 @@ logging.getLogger('botocore').setLevel(logging.WARNING)
 logging.getLogger('boto3').setLevel(logging.WARNING)
 logging.getLogger('urllib3').setLevel(logging.WARNING)
 
+# Number of accounts whose cross account role is tested at the same time
+ROLE_VALIDATION_WORKERS = int(os.getenv('ROLE_VALIDATION_WORKERS', default=10))
+_thread_local = threading.local()
+
 
 # Lambda main routine
 def handler(event, context):
@@ -29,6 +35,7 @@ def handler(event, context):
     new_event = event['Payload']['AWS-Inventory']
 
     for payer_id in new_event['payer']:
+        start_time = time.time()
         payer_creds = get_account_creds(payer_id)
         if payer_creds is False:
             logger.error("Unable to assume role in payer {}".format(payer_id))
@@ -36,26 +43,29 @@ def handler(event, context):
 
         logger.info("Processing payer {}".format(payer_id))
         payer_account_list = get_consolidated_billing_subaccounts(payer_creds)
+        list_time = time.time()
         for a in payer_account_list:
             if 'Payer Id' not in a:
                 a['Payer Id'] = payer_id
 
-            # Update the stuff from AWS Organizations
-            create_or_update_account(a, account_table)
-
-            # Now test the cross-account role if the account is active
-            if a[u'Status'] == "ACTIVE":
-                my_account = AWSAccount(a['Id'])
-                try:
-                    creds = my_account.get_creds(session_name="test-audit-access")
-                    # If an exception isn't thrown, this account is good.
-                    # Add it to the list to process, and update the account's attribute
-                    account_list.append(a['Id'])
-                    my_account.update_attribute('cross_account_role', my_account.cross_account_role_arn)
-                except AntiopeAssumeRoleError as e:
-                    # Otherwise we log the error
-                    logger.error("Unable to assume role into {}({})".format(a['Name'], a['Id']))
-                    pass
+        # Now test the cross-account role of the active accounts
+        active_ids = [a['Id'] for a in payer_account_list if a[u'Status'] == "ACTIVE"]
+        with ThreadPoolExecutor(max_workers=ROLE_VALIDATION_WORKERS) as executor:
+            role_arns = dict(zip(active_ids, executor.map(test_account_creds, active_ids)))
+        validate_time = time.time()
+
+        # If an exception wasn't thrown, the account is good. Add it to the list to process
+        for account_id in active_ids:
+            if role_arns[account_id] is not False:
+                account_list.append(account_id)
+
+        # Update the stuff from AWS Organizations, and the cross_account_role for the ones that work
+        save_accounts(payer_account_list, role_arns, account_table)
+        save_time = time.time()
+
+        logger.info(f"Payer {payer_id}: listed {len(payer_account_list)} accounts in {list_time - start_time:.1f} sec, "
+                    f"tested {len(active_ids)} roles in {validate_time - list_time:.1f} sec, "
+                    f"saved accounts in {save_time - validate_time:.1f} sec")
 
         # Trigger the Payer-Level Functions
         message = new_event.copy()
@@ -88,14 +98,16 @@ def get_account_creds(account_id):
 # end get_account_creds()
 
 
-def test_account_creds(account_id):
+def test_account_creds(account_id, session_name="test-audit-access"):
+    '''Returns the cross account role arn if we can assume it, otherwise False'''
     role_arn = "arn:aws:iam::{}:role/{}".format(account_id, os.environ['ROLE_NAME'])
-    client = boto3.client('sts')
+    client = get_cached_client('sts')
     try:
-        session = client.assume_role(RoleArn=role_arn, RoleSessionName=os.environ['ROLE_SESSION_NAME'])
+        session = client.assume_role(RoleArn=role_arn, RoleSessionName=session_name)
         return(role_arn)
-    except Exception as e:
-        logger.error(u"Failed to assume role {} in payer account {}: {}".format(role_arn, account_id, e))
+    except ClientError as e:
+        # Otherwise we log the error
+        logger.error(u"Unable to assume role {} in account {}: {}".format(role_arn, account_id, e.response['Error']['Code']))
         return(False)
 # end test_account_creds()
 
@@ -120,11 +132,10 @@ def get_consolidated_billing_subaccounts(session_creds):
     try:
 
         output = []
-        response = org_client.list_accounts(MaxResults=20)
+        response = list_accounts(org_client)
         while 'NextToken' in response:
             output = output + response['Accounts']
-            time.sleep(1)
-            response = org_client.list_accounts(MaxResults=20, NextToken=response['NextToken'])
+            response = list_accounts(org_client, NextToken=response['NextToken'])
 
         output = output + response['Accounts']
         return(output)
@@ -197,22 +208,61 @@ def get_consolidated_billing_subaccounts(session_creds):
 # end get_consolidated_billing_subaccounts()
 
 
-def create_or_update_account(a, account_table):
+def list_accounts(org_client, **kwargs):
+    '''Get a page of 20 (the max) accounts, backing off only if Organizations throttles us'''
+    delay = 1
+    for attempt in range(5):
+        try:
+            return(org_client.list_accounts(MaxResults=20, **kwargs))
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'TooManyRequestsException' or attempt == 4:
+                raise
+            logger.warning(f"Throttled listing accounts, sleeping {delay} sec")
+            time.sleep(delay)
+            delay = delay * 2
+# end list_accounts()
+
+
+def save_accounts(payer_account_list, role_arns, account_table):
+    '''
+    Update the fields from AWS Organizations (and the cross_account_role for accounts where it worked) on each account.
+    Only these attributes are SET, so anything else in the record written by other functions is left alone.
+    '''
+    with ThreadPoolExecutor(max_workers=ROLE_VALIDATION_WORKERS) as executor:
+        # list() so the first AccountUpdateError is raised here
+        list(executor.map(lambda a: create_or_update_account(a, role_arns.get(a[u'Id']), account_table.name), payer_account_list))
+# end save_accounts()
+
+
+def create_or_update_account(a, cross_account_role, table_name):
     logger.info(u"Adding account {} with name {} and email {}".format(a[u'Id'], a[u'Name'], a[u'Email']))
     if 'JoinedTimestamp' in a:
         a[u'JoinedTimestamp'] = a[u'JoinedTimestamp'].isoformat()  # Gotta convert to make the json save
+    update_expression = "set account_name=:name, account_status=:status, payer_id=:payer_id, root_email=:root_email, payer_record=:payer_record"
+    values = {
+        ':name':        a[u'Name'],
+        ':status':      a[u'Status'],
+        ':payer_id':    a[u'Payer Id'],
+        ':root_email':  a[u'Email'],
+        ':payer_record': a
+    }
+    if cross_account_role:
+        update_expression += ", cross_account_role=:cross_account_role"
+        values[':cross_account_role'] = cross_account_role
     try:
-        response = account_table.update_item(
+        response = get_account_table(table_name).update_item(
             Key= {'account_id': a[u'Id']},
-            UpdateExpression="set account_name=:name, account_status=:status, payer_id=:payer_id, root_email=:root_email, payer_record=:payer_record",
-            ExpressionAttributeValues={
-                ':name':        a[u'Name'],
-                ':status':      a[u'Status'],
-                ':payer_id':    a[u'Payer Id'],
-                ':root_email':  a[u'Email'],
-                ':payer_record': a
-            }
+            UpdateExpression=update_expression,
+            ExpressionAttributeValues=values
         )
-
     except ClientError as e:
         raise AccountUpdateError(u"Unable to create {}: {}".format(a[u'Name'], e))
+# end create_or_update_account()
+
+
+def get_account_table(table_name):
+    '''boto3 resources aren't thread safe, so each save_accounts() worker thread gets its own Table'''
+    if not hasattr(_thread_local, 'account_table'):
+        _thread_local.account_table = new_resource('dynamodb').Table(table_name)
+    return(_thread_local.account_table)
+# end get_account_table()
@@ -4,11 +4,11 @@ import json
 import os
 import time
 import datetime
-from mako.template import Template
 
 from antiope.aws_account import *
 from antiope.config import AccountLookupError
 from common import *
+from report_renderer import render_to_s3, save_json_to_s3
 
 import logging
 logger = logging.getLogger()
@@ -41,6 +41,10 @@ def handler(event, context):
     active_accounts = get_active_accounts()
     active_accounts.sort(key=lambda x: x.account_name.lower())
 
+    # Look up all the payers at once. Ones that aren't in the database must be orphans
+    for payer in get_accounts({str(a.payer_id) for a in active_accounts}):
+        payers[payer.account_id] = payer.account_name
+
     for a in active_accounts:
         logger.info(a.account_name)
 
@@ -50,17 +54,7 @@ def handler(event, context):
         # We don't want to save the entire object's attributes.
         j = a.db_record.copy()
 
-        try:
-            if str(a.payer_id) in payers:
-                j['payer_name'] = payers[str(a.payer_id)]
-            else:
-                payer = AWSAccount(str(a.payer_id))
-                j['payer_name'] = payer.account_name
-                payers[payer.account_id] = payer.account_name
-        except LookupError:
-            logger.debug("Unable to find the payer in the database. Must be an orphan")
-            j['payer_name'] = "Unknown Payer"
-            payers[str(a.payer_id)] = "Unknown Payer"
+        j['payer_name'] = payers.get(str(a.payer_id), "Unknown Payer")
 
         # Build the cross account role link
         if hasattr(a, 'cross_account_role') and a.cross_account_role is not None:
@@ -73,20 +67,10 @@ def handler(event, context):
     json_data['account_count'] = len(active_accounts)
     json_data['bucket'] = os.environ['INVENTORY_BUCKET']
 
-    fh = open("html_templates/account_inventory.html", "r")
-    mako_body = fh.read()
-    result = Template(mako_body).render(**json_data)
-
-    # Save HTML and json to S3
-    s3_client = boto3.client('s3')
+    # Render the Webpage and save HTML and json to S3
+    s3_client = get_cached_client('s3')
     try:
-        response = s3_client.put_object(
-            # ACL='public-read',
-            Body=result,
-            Bucket=os.environ['INVENTORY_BUCKET'],
-            ContentType='text/html',
-            Key='Reports/account_inventory.html',
-        )
+        render_to_s3("account_inventory.html", 'Reports/account_inventory.html', **json_data)
 
         # Save a txt file of all the active account IDs
         response = s3_client.put_object(
@@ -98,13 +82,7 @@ def handler(event, context):
         )
 
         # Save the JSON to S3
-        response = s3_client.put_object(
-            # ACL='public-read',
-            Body=json.dumps(json_data, sort_keys=True, indent=2, default=str),
-            Bucket=os.environ['INVENTORY_BUCKET'],
-            ContentType='application/json',
-            Key='Reports/account_inventory.json',
-        )
+        save_json_to_s3(json_data, 'Reports/account_inventory.json')
     except ClientError as e:
         logger.error("ClientError saving report: {}".format(e))
         raise
@@ -4,11 +4,11 @@ import json
 import os
 import time
 import datetime
-from mako.template import Template
 
 from antiope.foreign_aws_account import *
 from antiope.aws_account import *
 from common import *
+from report_renderer import render_to_s3, save_json_to_s3
 
 import logging
 logger = logging.getLogger()
@@ -53,30 +53,12 @@ def handler(event, context):
     json_data['account_count'] = len(active_accounts)
     json_data['bucket'] = os.environ['INVENTORY_BUCKET']
 
-    # Render the Webpage
-    fh = open("html_templates/foreign_inventory.html", "r")
-    mako_body = fh.read()
-    result = Template(mako_body).render(**json_data)
-
-    # Save HTML and json to S3
-    s3_client = boto3.client('s3')
+    # Render the Webpage and save HTML and json to S3
     try:
-        response = s3_client.put_object(
-            # ACL='public-read',
-            Body=result,
-            Bucket=os.environ['INVENTORY_BUCKET'],
-            ContentType='text/html',
-            Key='Reports/foreign_inventory.html',
-        )
+        render_to_s3("foreign_inventory.html", 'Reports/foreign_inventory.html', **json_data)
 
         # Save the JSON to S3
-        response = s3_client.put_object(
-            # ACL='public-read',
-            Body=json.dumps(json_data, sort_keys=True, indent=2, default=str),
-            Bucket=os.environ['INVENTORY_BUCKET'],
-            ContentType='application/json',
-            Key='Reports/foreign_inventory.json',
-        )
+        save_json_to_s3(json_data, 'Reports/foreign_inventory.json')
     except ClientError as e:
         logger.error("ClientError saving report: {}".format(e))
         raise
@@ -5,6 +5,10 @@ import os
 import time
 import datetime
 import csv
+import io
+import gzip
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from antiope.aws_account import *
 from common import *
 
@@ -43,6 +47,11 @@ credential_report_header = [
 
 prefix_header = ["account_name", "account_id", "payer_name"]
 
+# Number of credential reports downloaded at the same time. Up to twice this many are held waiting for the writer
+CREDENTIAL_REPORT_FETCH_WORKERS = int(os.getenv('CREDENTIAL_REPORT_FETCH_WORKERS', default=16))
+# Also save a gzipped copy of the combined report
+CREDENTIAL_REPORT_GZIP = os.getenv('CREDENTIAL_REPORT_GZIP', default="False") == "True"
+
 
 # Lambda main routine
 def handler(event, context):
@@ -53,63 +62,88 @@ def handler(event, context):
     active_accounts = get_active_accounts()
     active_accounts.sort(key=lambda x: x.account_name.lower())
 
-    s3_client = boto3.client('s3')
-
-    tmp_csv = f"/tmp/CombinedCredentialReports-{event['timestamp']}.csv"
-    with open(tmp_csv, 'w') as csvoutfile:
-        writer = csv.writer(csvoutfile, delimiter=',', quotechar='"', quoting=csv.QUOTE_ALL)
-        writer.writerow(prefix_header + credential_report_header)
-
-        for a in active_accounts:
-            logger.debug(a.account_name)
-
-            # We will prefix all the rows in the final report with this
-            account_row = [a.account_name, a.account_id, a.payer_id]
-
-            # Pull the Credential report Antiope generated
-            object_key = f"CredentialReports/{a.account_id}-{event['timestamp']}.csv"
-            try:
-                response = s3_client.get_object(
-                    Bucket=os.environ['INVENTORY_BUCKET'],
-                    Key=object_key
-                )
-                csv_body = str(response['Body'].read().decode("utf-8"))
-                reader = csv.reader(csv_body.splitlines())
-            except ClientError as e:
-                logger.error(f"ClientError getting credential for {a.account_id}: {e}")
+    combined_key = f"CredentialReports/Combined-{event['timestamp']}.csv"
+    csvoutfile = S3MultipartWriter(combined_key, 'text/csv')
+    gzoutfile = None
+    if CREDENTIAL_REPORT_GZIP:
+        gzoutfile = S3MultipartWriter(f"{combined_key}.gz", 'application/gzip')
+    try:
+        gzfile = gzip.GzipFile(fileobj=gzoutfile, mode='wb') if gzoutfile else None
+
+        write_rows(csvoutfile, gzfile, [prefix_header + credential_report_header])
+        for a, rows in fetch_credential_reports(active_accounts, event['timestamp']):
+            if rows is None:
                 continue
-
             # For each row in the report, prepend the account info and write to the final CSV
-            iter_rows = iter(reader)
-            next(iter_rows)  # Skip the first row
-            for row in iter_rows:
-                writer.writerow(account_row + row)
-
-    csvoutfile.close()
-    save_report_to_s3(event, tmp_csv)
-    return(event)
-
-
-def save_report_to_s3(event, tmp_csv):
-    client   = boto3.client('s3')
-
-    csvfile  = open(tmp_csv, 'rb')
-    response = client.put_object(
-        Body=csvfile,
+            account_row = [a.account_name, a.account_id, a.payer_id]
+            write_rows(csvoutfile, gzfile, [account_row + row for row in rows])
+
+        if gzfile:
+            gzfile.close()  # Writes the gzip trailer, but leaves gzoutfile open
+            gzoutfile.close()
+        csvoutfile.close()
+    except Exception:
+        csvoutfile.abort()
+        if gzoutfile:
+            gzoutfile.abort()
+        raise
+
+    # The alias is copied inside S3 rather than uploaded a second time
+    s3_client = get_cached_client('s3')
+    s3_client.copy_object(
         Bucket=os.environ['INVENTORY_BUCKET'],
+        CopySource={'Bucket': os.environ['INVENTORY_BUCKET'], 'Key': combined_key},
+        Key='Reports/CredentialReport.csv',
         ContentType='text/csv',
-        Key=f"CredentialReports/Combined-{event['timestamp']}.csv",
+        MetadataDirective='REPLACE',
     )
-    csvfile.seek(0)
+    return(event)
 
-    response = client.put_object(
-        # ACL='public-read',
-        Body=csvfile,
-        Bucket=os.environ['INVENTORY_BUCKET'],
-        ContentType='text/csv',
-        Key='Reports/CredentialReport.csv',
-    )
-    csvfile.close()
+
+def fetch_credential_reports(accounts, timestamp):
+    '''
+    Yields (account, rows) in the order of accounts, with rows None if the report couldn't be fetched.
+    The reports are downloaded in parallel, only staying a limited number of accounts ahead of the caller.
+    '''
+    with ThreadPoolExecutor(max_workers=CREDENTIAL_REPORT_FETCH_WORKERS) as executor:
+        pending = deque()
+        for a in accounts:
+            pending.append((a, executor.submit(get_credential_report_rows, a, timestamp)))
+            if len(pending) >= CREDENTIAL_REPORT_FETCH_WORKERS * 2:
+                a, future = pending.popleft()
+                yield(a, future.result())
+        while pending:
+            a, future = pending.popleft()
+            yield(a, future.result())
+
+
+def get_credential_report_rows(account, timestamp):
+    '''Pull the Credential report Antiope generated, returning its rows without the header'''
+    logger.debug(account.account_name)
+    s3_client = get_cached_client('s3')
+    object_key = f"CredentialReports/{account.account_id}-{timestamp}.csv"
+    try:
+        response = s3_client.get_object(
+            Bucket=os.environ['INVENTORY_BUCKET'],
+            Key=object_key
+        )
+        reader = csv.reader(io.StringIO(response['Body'].read().decode("utf-8")))
+        next(reader, None)  # Skip the first row
+        return(list(reader))
+    except ClientError as e:
+        logger.error(f"ClientError getting credential for {account.account_id}: {e}")
+        return(None)
+
+
+def write_rows(csvoutfile, gzfile, rows):
+    '''Format the rows as CSV once, and write them to the report and the gzipped copy'''
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=',', quotechar='"', quoting=csv.QUOTE_ALL)
+    writer.writerows(rows)
+    data = buffer.getvalue().encode('utf-8')
+    csvoutfile.write(data)
+    if gzfile:
+        gzfile.write(data)
 
 
 if __name__ == '__main__':
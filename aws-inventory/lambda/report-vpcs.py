@@ -4,11 +4,12 @@ import json
 import os
 import time
 import datetime
-from mako.template import Template
+from boto3.dynamodb.conditions import Attr
 
 from antiope.aws_account import *
 from antiope.vpc import *
 from common import *
+from report_renderer import render_to_s3, save_json_to_s3
 
 import logging
 logger = logging.getLogger()
@@ -30,22 +31,22 @@ def handler(event, context):
     active_accounts = get_active_accounts()
     active_accounts.sort(key=lambda x: x.account_name.lower())
 
+    # One parallel scan of the VPC table, rather than a query per account. Skip VPCs that have nothing in them
+    vpcs_by_account = {}
+    for vpc in scan_table(os.environ['VPC_TABLE'],
+                          filter_expression=Attr('instance_states.running').gt(0) | Attr('instance_states.stopped').gt(0)):
+        vpcs_by_account.setdefault(vpc['account_id'], []).append(vpc)
+
     for a in active_accounts:
         logger.debug(a.account_name)
 
-        for v in a.get_vpcs():
-            logger.debug(f"\tv.vpc_id")
+        for vpc in sorted(vpcs_by_account.get(a.account_id, []), key=lambda v: v['vpc_id']):
+            logger.debug(f"\t{vpc['vpc_id']}")
+            vpc.setdefault('name', vpc['vpc_id'])  # Make sure there is a name, if not then use the VPC ID
             j = {}
-            j['vpc'] = v.db_record.copy()
+            j['vpc'] = vpc
             j['account'] = a.db_record.copy()
-
-            # Skip VPCs that have nothing in them
-            if not hasattr(v, "instance_states"):
-                continue
-            if v.instance_states['running'] == 0 and v.instance_states['stopped'] == 0:
-                continue
-
-            j['instance_states'] = v.instance_states
+            j['instance_states'] = vpc['instance_states']
             json_data['vpcs'].append(j)
 
     # Add some summary data for the Template
@@ -54,30 +55,12 @@ def handler(event, context):
     json_data['account_count'] = len(active_accounts)
     json_data['bucket'] = os.environ['INVENTORY_BUCKET']
 
-    # Render the Webpage
-    fh = open("html_templates/vpc_inventory.html", "r")
-    mako_body = fh.read()
-    result = Template(mako_body).render(**json_data)
-
-    # Save HTML and json to S3
-    s3_client = boto3.client('s3')
+    # Render the Webpage and save HTML and json to S3
     try:
-        response = s3_client.put_object(
-            # ACL='public-read',
-            Body=result,
-            Bucket=os.environ['INVENTORY_BUCKET'],
-            ContentType='text/html',
-            Key='Reports/vpc_inventory.html',
-        )
+        render_to_s3("vpc_inventory.html", 'Reports/vpc_inventory.html', **json_data)
 
         # Save the JSON to S3
-        response = s3_client.put_object(
-            # ACL='public-read',
-            Body=json.dumps(json_data, sort_keys=True, indent=2, default=str),
-            Bucket=os.environ['INVENTORY_BUCKET'],
-            ContentType='application/json',
-            Key='Reports/vpc_inventory.json',
-        )
+        save_json_to_s3(json_data, 'Reports/vpc_inventory.json')
     except ClientError as e:
         logger.error("ClientError saving report: {}".format(e))
         raise
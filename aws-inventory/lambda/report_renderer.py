@@ -0,0 +1,33 @@
+import json
+import os
+
+from mako.lookup import TemplateLookup
+from mako.runtime import Context
+
+from common import *
+
+import logging
+logger = logging.getLogger()
+
+# Templates are compiled once per container and kept in the lookup. The compiled modules also go to /tmp,
+# so a new container only has to recompile if the template changed.
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "html_templates")
+TEMPLATE_MODULE_DIR = os.getenv('TEMPLATE_MODULE_DIR', default="/tmp/mako_modules")
+
+template_lookup = TemplateLookup(directories=[TEMPLATE_DIR], module_directory=TEMPLATE_MODULE_DIR)
+
+
+def render_to_s3(template_name, object_key, content_type='text/html', **data):
+    """Render html_templates/template_name with data, streaming the output straight to object_key in the bucket"""
+    template = template_lookup.get_template(template_name)
+    with S3MultipartWriter(object_key, content_type) as writer:
+        template.render_context(Context(writer, **data))
+    logger.debug(f"Rendered {template_name} to {object_key}: {writer.size} bytes")
+
+
+def save_json_to_s3(data, object_key):
+    """Encode data a piece at a time into object_key, rather than building the whole JSON string first"""
+    encoder = json.JSONEncoder(sort_keys=True, indent=2, default=str)
+    with S3MultipartWriter(object_key, 'application/json') as writer:
+        for chunk in encoder.iterencode(data):
+            writer.write(chunk)
@@ -4,6 +4,8 @@ import json
 import os
 import time
 
+from common import *
+
 import logging
 logger = logging.getLogger()
 logger.setLevel(getattr(logging, os.getenv('LOG_LEVEL', default='INFO')))
@@ -11,12 +13,20 @@ logging.getLogger('botocore').setLevel(logging.WARNING)
 logging.getLogger('boto3').setLevel(logging.WARNING)
 logging.getLogger('urllib3').setLevel(logging.WARNING)
 
-hurry_up = 800.00  # after this number of seconds, stop delaying between publish and just send the rest. We want to finish before we expire.
-# TODO - have this function return unfinished work to the step function for another pass.
+# How many accounts per second to send to the inventory topic, and how many can go out at once.
+# This spreads the account inventory Lambdas out so they don't all hit the same APIs at the same time.
+dispatch_rate = float(os.getenv('DISPATCH_RATE', default=2))
+dispatch_burst = int(os.getenv('DISPATCH_BURST', default=10))
+
+# When there are fewer than this many seconds left, stop and return the unsent accounts to the step function for another pass.
+time_margin = int(os.getenv('DISPATCH_TIME_MARGIN', default=60))
+
+# Give up on accounts that still haven't been sent after this many passes, so a persistent failure can't loop the step function forever
+max_passes = int(os.getenv('DISPATCH_MAX_PASSES', default=5))
 
-# Increase this number to shorten the interval between SNS Publish calls.
-# The last digit of the account_id is divided by this number to create the number of seconds of delay.
-accel_factor = int(os.environ['ACCEL_FACTOR'])
+# publish_batch() takes up to 10 messages. A batch can't be bigger than the burst, because TokenBucket.acquire() never
+# waits for more than a burst's worth of tokens and the extra accounts would go out unpaced.
+BATCH_SIZE = max(1, min(10, dispatch_burst))
 
 
 # Lambda main routine
@@ -25,35 +35,78 @@ def handler(event, context):
 
     client = boto3.client('sns')
 
+    # On the first pass we send everything. If we ran out of time last pass, the step function hands back what's left.
+    if 'pending_account_list' in event:
+        pending = event['pending_account_list']
+    else:
+        pending = event['account_list']
+
+    message = event.copy()
+    for k in ['account_list', 'pending_account_list', 'dispatch_complete', 'dispatch_pass']:
+        message.pop(k, None)  # Don't need to send this along to each lamdba
+
+    if 'nowait' in event and event['nowait'] is True:
+        bucket = None
+    else:
+        bucket = TokenBucket(dispatch_rate, dispatch_burst)
+
     start_time = time.time()
+    sent = 0
+    waited = 0.0
+    retry = []
+    i = 0
+    while i < len(pending):
+        if context.get_remaining_time_in_millis() < time_margin * 1000:
+            logger.warning(f"Running out of time with {len(pending) - i} accounts left to send. Returning them to the step function")
+            break
 
-    for account_id in event['account_list']:
+        batch = pending[i:i + BATCH_SIZE]
+        i += len(batch)
+        if bucket is not None:
+            waited += bucket.acquire(len(batch))
+        sent += len(batch)
+        retry += publish_accounts(client, message, batch)
 
-        message = event.copy()
-        del(message['account_list'])  # Don't need to send this along to each lamdba
-        message['account_id'] = account_id  # Which account to process
+    remaining = pending[i:] + retry
+    logger.info(f"Sent {sent - len(retry)} accounts in {time.time() - start_time:.1f} sec ({waited:.1f} sec pacing). {len(remaining)} left for the next pass")
 
-        # Sleep between 0 and 9 seconds before sending the message.
-        if 'nowait' in event and event['nowait'] is True:
-            response = client.publish(
-                TopicArn=os.environ['TRIGGER_ACCOUNT_INVENTORY_ARN'],
-                Message=json.dumps(message)
-            )
-        else:
-            # if we've still got more than hurry_up time left, do the delay.
-            logger.debug(f"{time.time()} - {start_time} < {hurry_up}")
-            if time.time() - start_time < hurry_up:
-                delay = int(message['account_id'][-1:]) / accel_factor
-                logger.debug(f"Delaying {delay} sec for account {account_id}")
-                time.sleep(delay)
-            logger.debug(f"Publishing for {account_id}")
-            response = client.publish(
-                TopicArn=os.environ['TRIGGER_ACCOUNT_INVENTORY_ARN'],
-                Message=json.dumps(message)
-            )
+    event['dispatch_pass'] = event.get('dispatch_pass', 0) + 1
+    if len(remaining) > 0 and event['dispatch_pass'] >= max_passes:
+        logger.error(f"Giving up on {len(remaining)} accounts after {event['dispatch_pass']} passes: {remaining}")
+        remaining = []
 
+    # Only what's left goes back to the step function. Carrying the full account_list along too would double the state,
+    # which is limited to 256KB
+    event.pop('account_list', None)
+    event['pending_account_list'] = remaining
+    event['dispatch_complete'] = len(remaining) == 0
     return(event)
 
 # end handler()
 
 ##############################################
+
+
+def publish_accounts(client, message, account_ids):
+    '''Publish one message per account in a single publish_batch() call. Returns the account_ids that should be tried again'''
+    entries = []
+    for n, account_id in enumerate(account_ids):
+        account_message = message.copy()
+        account_message['account_id'] = account_id  # Which account to process
+        entries.append({'Id': str(n), 'Message': json.dumps(account_message)})
+
+    try:
+        response = client.publish_batch(TopicArn=os.environ['TRIGGER_ACCOUNT_INVENTORY_ARN'], PublishBatchRequestEntries=entries)
+    except ClientError as e:
+        logger.error(f"Unable to publish {len(account_ids)} accounts: {e}")
+        return(account_ids)
+
+    retry = []
+    for failure in response.get('Failed', []):
+        account_id = account_ids[int(failure['Id'])]
+        if failure['SenderFault']:
+            logger.error(f"Unable to publish account {account_id}: {failure['Code']} {failure.get('Message')}")
+        else:
+            logger.warning(f"Publish of account {account_id} failed, will retry: {failure['Code']} {failure.get('Message')}")
+            retry.append(account_id)
+    return(retry)
@@ -1,4 +1,5 @@
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
 import re
 import requests
@@ -6,9 +7,12 @@ from requests_aws4auth import AWS4Auth
 import json
 import os
 import time
+import random
 import datetime
 from dateutil import tz
 from urllib.parse import unquote
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple
 
 import logging
 logger = logging.getLogger()
@@ -29,21 +33,62 @@ if 'EXCLUDED_RESOURCE_PREFIXES' in os.environ:
     if os.environ['EXCLUDED_RESOURCE_PREFIXES'] != '':
         excluded_resource_prefixes=os.environ['EXCLUDED_RESOURCE_PREFIXES'].split(',')
 
+# Cap each _bulk request so a large SQS batch can't go over the ES domain's HTTP request size limit (10MB on the smallest instances)
+BULK_MAX_BYTES = int(os.getenv('BULK_MAX_BYTES', default=5 * 1024 * 1024))
+BULK_MAX_DOCS = int(os.getenv('BULK_MAX_DOCS', default=500))
+BULK_MIN_DOCS = int(os.getenv('BULK_MIN_DOCS', default=10))
+
+# Documents ES rejects with a 429 (es_rejected_execution_exception, its write queue is full) are retried this many times
+# with exponential backoff and full jitter, so concurrent Lambdas don't all come back at once.
+BULK_RETRY_ATTEMPTS = int(os.getenv('BULK_RETRY_ATTEMPTS', default=4))
+BULK_RETRY_BASE_DELAY = float(os.getenv('BULK_RETRY_BASE_DELAY', default=0.5))
+BULK_RETRY_MAX_DELAY = float(os.getenv('BULK_RETRY_MAX_DELAY', default=8))
+
+# Kept across warm invocations so we reuse the TLS connection to ES and don't rebuild the SigV4 signer every time
+session = requests.Session()
+session.headers.update({"Content-Type": "application/json"})
+awsauth = None
+
+# Objects in the batch are fetched from S3 this many at a time, all sharing one pooled client
+S3_FETCH_WORKERS = int(os.getenv('S3_FETCH_WORKERS', default=16))
+s3_client = boto3.client('s3', config=Config(max_pool_connections=S3_FETCH_WORKERS))
+
+# One index command for the _bulk API, along with the SQS message and S3 object it came from
+BulkAction = namedtuple('BulkAction', ['message_id', 'obj_key', 'body'])
+
+
+
+class AdaptiveChunkSize(object):
+    """
+    Number of documents to send per _bulk request. It shrinks in proportion to the share of documents ES rejects
+    (a chunk that is entirely rejected halves it) and grows back by a tenth of BULK_MAX_DOCS after each clean chunk.
+    """
+    def __init__(self, max_docs, min_docs):
+        super(AdaptiveChunkSize, self).__init__()
+        self.limit = max_docs
+        self.min_docs = min(min_docs, max_docs)
+        self.max_docs = max_docs
+
+    def record(self, sent, rejected):
+        if rejected > 0:
+            self.max_docs = max(self.min_docs, int(self.max_docs * (1 - rejected / sent / 2)))
+        else:
+            self.max_docs = min(self.limit, self.max_docs + max(1, self.limit // 10))
+
+
+# Kept across warm invocations so a Lambda that has been backing off doesn't start out at full size again
+chunk_size = AdaptiveChunkSize(BULK_MAX_DOCS, BULK_MIN_DOCS)
+
 print( excluded_resource_prefixes )
 # Lambda execution starts here
 def lambda_handler(event, context):
     logger.debug("Received event: " + json.dumps(event, sort_keys=True))
 
-    region = os.environ['AWS_REGION']
-    service = 'es'
-    credentials = boto3.Session().get_credentials()
-    awsauth = AWS4Auth(credentials.access_key, credentials.secret_key, region, service, session_token=credentials.token)
-
     es_type = "_doc"  # This is what es is moving to after deprecating types in 6.0
-    headers = {"Content-Type": "application/json"}
 
-    bulk_ingest_body = ""
+    bulk_actions = []
     count = 0
+    s3_objects = []
 
     for record in event['Records']:
         message = json.loads(record['body'])
@@ -60,86 +105,187 @@ def lambda_handler(event, context):
                 logger.info( f"Prefix {obj_key} excluded: skipping insertion into ES" )
                 continue
 
-            resource_to_index = get_object(bucket, obj_key)
-            if resource_to_index is None:
-                continue
+            s3_objects.append((record['messageId'], bucket, obj_key))
 
-            # This is a shitty hack to get around the fact Principal can be "*" or {"AWS": "*"} in an IAM Statement
-            modified_resource_to_index = fix_principal(resource_to_index)
+    # SQS messages with a document that didn't get indexed. Only these are returned to the queue to be retried.
+    failed_messages = set()
 
-            # Time is required to have '.' and 6 digits of precision following.  Some items lack the precision so add it.
-            if "configurationItemCaptureTime" in modified_resource_to_index:
-                if '.' not in modified_resource_to_index[ "configurationItemCaptureTime"]:
-                    modified_resource_to_index[ "configurationItemCaptureTime" ] += ".000000"
+    # Fetch everything at once. Results are read in the same order as s3_objects so the bulk body is deterministic
+    with ThreadPoolExecutor(max_workers=S3_FETCH_WORKERS) as executor:
+        futures = [executor.submit(get_object, bucket, obj_key) for message_id, bucket, obj_key in s3_objects]
+
+    for (message_id, bucket, obj_key), future in zip(s3_objects, futures):
+        try:
+            resource_to_index = future.result()
+        except Exception as e:
+            # Throttling, 5xx, AccessDenied, timeouts or a truncated body. The message goes back to the queue to try again
+            logger.error("Error getting resource s3://{}/{}: {}".format(bucket, obj_key, e))
+            failed_messages.add(message_id)
+            continue
+        if resource_to_index is None:
+            continue
 
-            # Now we need to build the ES command. We need the index and document name from the object_key
-            key_parts = obj_key.split("/")
-            # The Elastic Search document id, is the object_name minus the file suffix
-            es_id = key_parts.pop().replace(".json", "")
+        # Rewrite the bits of the document that conflict with the ES mappings. This modifies the document in place.
+        modified_resource_to_index = normalize_document(resource_to_index)
 
-            # The Elastic Search Index is the remaining object prefix, all lowercase with the "/" replaced by "_"
-            index = "_".join(key_parts).lower()
+        # Now we need to build the ES command. We need the index and document name from the object_key
+        key_parts = obj_key.split("/")
+        # The Elastic Search document id, is the object_name minus the file suffix
+        es_id = key_parts.pop().replace(".json", "")
 
-            # Now concat that all together for the Bulk API
-            # https://www.elastic.co/guide/en/elasticsearch/reference/current/docs-bulk.html
+        # The Elastic Search Index is the remaining object prefix, all lowercase with the "/" replaced by "_"
+        index = "_".join(key_parts).lower()
 
-            command = {"index": {"_index": index, "_type": "_doc", "_id": es_id}}
-            command_str = json.dumps(command, separators=(',', ':'))
-            document = json.dumps(modified_resource_to_index, separators=(',', ':'))
-            bulk_ingest_body += f"{command_str}\n{document}\n"
-            count += 1
+        # Now concat that all together for the Bulk API
+        # https://www.elastic.co/guide/en/elasticsearch/reference/current/docs-bulk.html
+
+        command = {"index": {"_index": index, "_type": "_doc", "_id": es_id}}
+        command_str = json.dumps(command, separators=(',', ':'))
+        document = json.dumps(modified_resource_to_index, separators=(',', ':'))
+        bulk_actions.append(BulkAction(message_id, obj_key, f"{command_str}\n{document}\n"))
+        count += 1
 
     # Don't call ES if there is nothing to do.
     if count == 0:
         logger.warning("No objects to index.")
-        return(event)
-
-    bulk_ingest_body += "\n"
+        return({"batchItemFailures": [{"itemIdentifier": message_id} for message_id in sorted(failed_messages)]})
+
+    metrics = {"Documents": count, "Requests": 0, "Rejected": 0, "Retried": 0, "Failed": 0}
+
+    # Now index the documents, one size limited chunk at a time
+    for chunk in chunk_bulk_actions(bulk_actions, BULK_MAX_BYTES, chunk_size):
+        try:
+            failures = index_chunk(chunk, metrics)
+        except Exception as e:
+            logger.critical(f"General Exception Indexing {len(chunk)} documents starting with {chunk[0].obj_key}: {e}")
+            failed_messages.update(action.message_id for action in chunk)
+            metrics['Failed'] += len(chunk)
+            continue
 
-    # all done processing the SQS messages. Send it to ES
+        for action, item in failures:
+            logger.error(f"Bulk Ingest Failure: {action.obj_key} Index {item['index']['_index']} ID {item['index']['_id']} Status {item['index']['status']} - {item}")
+            failed_messages.add(action.message_id)
+            metrics['Failed'] += 1
+
+    log_metrics(metrics)
+    if len(failed_messages) > 0:
+        logger.warning(f"Returning {len(failed_messages)} of {len(event['Records'])} messages to the queue")
+    return({"batchItemFailures": [{"itemIdentifier": message_id} for message_id in sorted(failed_messages)]})
+
+
+def index_chunk(chunk, metrics):
+    '''
+    Send the chunk to ES. Documents that come back 429 are resent on their own with exponential backoff and jitter.
+    Returns a list of (BulkAction, item) for the documents that failed for any other reason or ran out of retries.
+    '''
+    pending = chunk
+    failures = []
+    for attempt in range(BULK_RETRY_ATTEMPTS + 1):
+        if attempt > 0:
+            delay = random.uniform(0, min(BULK_RETRY_MAX_DELAY, BULK_RETRY_BASE_DELAY * 2 ** attempt))
+            logger.warning(f"ES rejected {len(pending)} documents, retrying in {delay:.2f} sec (attempt {attempt} of {BULK_RETRY_ATTEMPTS})")
+            time.sleep(delay)
+            metrics['Retried'] += len(pending)
+
+        response = send_bulk(pending)
+        metrics['Requests'] += 1
+
+        rejected = []
+        # The bulk API returns one item per action, in the order they were sent
+        for action, item in zip(pending, response['items']):
+            if 'index' not in item:
+                logger.error(f"Item {item} was not of type index. Huh?")
+                continue
+            if item['index']['status'] == 201 or item['index']['status'] == 200:
+                continue
+            if item['index']['status'] == 429:
+                rejected.append((action, item))
+            else:
+                failures.append((action, item))
+
+        chunk_size.record(len(pending), len(rejected))
+        metrics['Rejected'] += len(rejected)
+        if len(rejected) == 0:
+            return(failures)
+        pending = [action for action, item in rejected]
+
+    return(failures + rejected)
+
+
+def log_metrics(metrics):
+    '''Log the invocation's counts in CloudWatch Embedded Metric Format so they show up as metrics without an API call'''
+    metrics['ChunkSize'] = chunk_size.max_docs
+    logger.info(f"Ingest metrics: {json.dumps(metrics, sort_keys=True)}")
+    print(json.dumps({
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": "Antiope/SearchIngest",
+                "Dimensions": [[]],
+                "Metrics": [{"Name": name, "Unit": "Count"} for name in sorted(metrics)]
+            }]
+        },
+        **metrics
+    }))
+
+
+def get_awsauth():
+    '''Return the SigV4 signer for ES, only building a new one when the Lambda's credentials change'''
+    global awsauth
+    credentials = boto3.Session().get_credentials().get_frozen_credentials()
+    if awsauth is None or awsauth.access_id != credentials.access_key or awsauth.session_token != credentials.token:
+        awsauth = AWS4Auth(credentials.access_key, credentials.secret_key, os.environ['AWS_REGION'], 'es', session_token=credentials.token)
+    return(awsauth)
+
+
+def chunk_bulk_actions(bulk_actions, max_bytes, chunk_size):
+    '''
+    Group the BulkActions into lists whose _bulk request body is at most max_bytes and chunk_size.max_docs.
+    chunk_size is checked for every chunk, so it can shrink or grow as the chunks are indexed.
+    A single action bigger than max_bytes is sent on its own.
+    '''
+    chunk = []
+    chunk_bytes = 0
+    for action in bulk_actions:
+        action_bytes = len(action.body.encode('utf-8'))
+        if chunk and (chunk_bytes + action_bytes > max_bytes or len(chunk) >= chunk_size.max_docs):
+            yield(chunk)
+            chunk = []
+            chunk_bytes = 0
+        chunk.append(action)
+        chunk_bytes += action_bytes
+    if chunk:
+        yield(chunk)
+
+
+def send_bulk(chunk):
+    '''Send one chunk of BulkActions to the ES _bulk API and return the parsed response'''
+    bulk_ingest_body = "".join(action.body for action in chunk) + "\n"
     logger.debug(bulk_ingest_body)
+    body = bulk_ingest_body.encode('utf-8')
+    count = len(chunk)
 
-    requeue_keys = []
+    start = time.time()
+    r = session.post(f"{host}/_bulk", auth=get_awsauth(), data=body)
+    duration = max(time.time() - start, 0.001)
 
-    try:
-        # Now index the document
-        r = requests.post(f"{host}/_bulk", auth=awsauth, data=bulk_ingest_body, headers=headers)
-
-        if not r.ok:
-            logger.error(f"Bulk Error: {r.status_code} took {r.elapsed} sec - {r.text}")
-            raise Exception
-
-        else:  # We need to make sure all the elements succeeded
-            response = r.json()
-            logger.info(f"Bulk ingest of {count} documents request took {r.elapsed} sec and processing took {response['took']} ms with errors: {response['errors']}")
-            if response['errors'] is False:
-                return(event)  # all done here
-
-            for item in response['items']:
-                if 'index' not in item:
-                    logger.error(f"Item {item} was not of type index. Huh?")
-                    continue
-                if item['index']['status'] != 201 and item['index']['status'] != 200:
-                    logger.error(f"Bulk Ingest Failure: Index {item['index']['_index']} ID {item['index']['_id']} Status {item['index']['status']} - {item}")
-                    requeue_keys.append(process_requeue(item))
-
-    except Exception as e:
-        logger.critical("General Exception Indexing s3://{}/{}: {}".format(bucket, obj_key, e))
-        raise
+    if r.status_code == 429:
+        # The whole request was rejected. Report every document as rejected so they all get retried
+        logger.warning(f"Bulk request of {count} documents rejected with 429 - {r.text}")
+        return({"took": 0, "errors": True, "items": [{"index": {"_index": None, "_id": None, "status": 429, "error": r.text}} for action in chunk]})
 
-    if len(requeue_keys) > 0:
-        requeue_objects(os.environ['INVENTORY_BUCKET'], requeue_keys)
+    if not r.ok:
+        logger.error(f"Bulk Error: {r.status_code} took {r.elapsed} sec - {r.text}")
+        raise Exception
 
+    response = r.json()
+    logger.info(f"Bulk ingest of {count} documents ({len(body)} bytes) request took {duration:.3f} sec "
+                f"({count / duration:.1f} docs/sec, {len(body) / duration / 1024:.1f} KB/sec) "
+                f"and processing took {response['took']} ms with errors: {response['errors']}")
+    return(response)
 
-def process_requeue(item):
-    # We must reverse the munge of the object key
-    prefix = item['index']['_index'].replace("_", "/").replace("resources", "Resources")
-    key = f"{prefix}/{item['index']['_id']}.json"
-    logger.warning(f"Requeueing {key} : {item}")
-    return(key)
 
-
-def fix_principal(json_doc):
+def fix_principal(value):
     """
     WTF are we doing here? Good Question!
     ElasticSearch has an oddity where it can't handle a attribute being a literal or another level of nesting. This becomes and issue when the "Principal" in a statement
@@ -157,57 +303,70 @@ def fix_principal(json_doc):
 
     Note: I believe that there is a distinction between Principal: * and Principal: AWS: * - the former indicates no AWS auth is occuring at all , whereas the AWS: * means any AWS Customer (having previously authenticated to their own account). Both are bad.
     """
+    if isinstance(value, str):
+        return({"ALL": value})
+    return(value)
 
-    string_to_match = '"Principal":"*"'
-    string_to_sub = '"Principal": { "ALL": "*"}'
-
-    # Convert to String, Make sure there are no spaces between json elements (so it can match with string_to_match)
-    json_string = json.dumps(json_doc, separators=(',', ':'), indent=None)
 
-    # print(f"In fix principal, json_string is {json_string}")
+def fix_capture_time(json_doc):
+    """Time is required to have '.' and 6 digits of precision following.  Some items lack the precision so add it."""
+    if "configurationItemCaptureTime" in json_doc:
+        if '.' not in json_doc["configurationItemCaptureTime"]:
+            json_doc["configurationItemCaptureTime"] += ".000000"
 
-    # Do the replace
-    modified_json_string = json_string.replace(string_to_match, string_to_sub)
 
-    # Convert back to dict
-    modified_json_doc = json.loads(modified_json_string)
+# Fixes for attributes that conflict with the ES mappings wherever they appear in a document.
+# Each is called with the attribute's value and returns the value to store in its place.
+KEY_NORMALIZERS = {
+    "Principal": fix_principal,
+}
 
-    return(modified_json_doc)
+# Fixes that apply to the document as a whole. Each is called with the document and modifies it in place.
+DOCUMENT_NORMALIZERS = [
+    fix_capture_time,
+]
 
 
-def requeue_objects(bucket, objects):
-    '''Drop any objects that were rejected because of thread issues back into the SQS queue to get ingested later'''
-
-    sqs_client = boto3.client('sqs')
-    queue_url = os.environ['SQS_QUEUE_URL']
-
-    body = {
-        'Records': []
-    }
-
-    for o in objects:
-        body['Records'].append({'s3': {'bucket': {'name': bucket}, 'object': {'key': o}}})
-
-    logger.warning(f"Re-queuing {len(objects)} Objects")
-    response = sqs_client.send_message(QueueUrl=queue_url, MessageBody=json.dumps(body))
-    return(len(objects))
+def normalize_document(json_doc):
+    """
+    Apply the KEY_NORMALIZERS to every matching key of every dict nested anywhere in json_doc, then the DOCUMENT_NORMALIZERS.
+    The document is modified in place (and returned) so it only has to be serialized once, when the bulk body is built.
+    """
+    stack = [json_doc]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            for key, value in node.items():
+                if key in KEY_NORMALIZERS:
+                    value = node[key] = KEY_NORMALIZERS[key](value)
+                if isinstance(value, (dict, list)):
+                    stack.append(value)
+        elif isinstance(node, list):
+            for value in node:
+                if isinstance(value, (dict, list)):
+                    stack.append(value)
+
+    for normalizer in DOCUMENT_NORMALIZERS:
+        normalizer(json_doc)
+    return(json_doc)
 
 
 def get_object(bucket, obj_key):
-    '''get the object to index from S3 and return the parsed json'''
-    s3 = boto3.client('s3')
+    '''
+    get the object to index from S3 and return the parsed json. Returns None if the object is gone, which no retry
+    will fix. Any other error is raised, so the caller can return the message to the queue.
+    '''
     try:
-        response = s3.get_object(
+        response = s3_client.get_object(
             Bucket=bucket,
             Key=unquote(obj_key)
         )
-        return(json.loads(response['Body'].read()))
     except ClientError as e:
         if e.response['Error']['Code'] == 'NoSuchKey':
             logger.error("Unable to find resource s3://{}/{}".format(bucket, obj_key))
-        else:
-            logger.error("Error getting resource s3://{}/{}: {}".format(bucket, obj_key, e))
-        return(None)
+            return(None)
+        raise
+    return(json.loads(response['Body'].read()))
 
 def prefix_excluded(s3key):
     for prefix in excluded_resource_prefixes: